@@ -1,20 +1,121 @@
 #!/usr/bin/env python3
+import tracing
+from tracing import log
 import gi
 gi.require_version('Gtk', '3.0')
-gi.require_version('PangoCairo', '1.0')
-from gi.repository import Gtk, Gdk, GLib, GdkPixbuf, Gio, cairo
-import math, os, codecs, sys, json, copy, glob
-import svg2cairo
+gi.require_version('GdkPixbuf', '2.0')
+with tracing.startup.timed("import Gtk"):
+    from gi.repository import Gtk, Gdk, GLib, Gio
+import math, os, codecs, sys, json, copy
+# svg2cairo, bubblelibrary, imageops and thumbnails (and Pango, pycairo,
+# GdkPixbuf, hashlib and the SVG parser) aren't imported up here; they're
+# imported where they're used, so that none of them get in the way of
+# putting the window up.
 
 __VERSION__ = "0.1"
 
 ALLOWED_FONTS = ["Impact", "Monospace", "Sans", "Serif"]
 
+# pasted images smaller than this are decoded in one go; bigger ones are
+# loaded a chunk at a time like a file, so the window doesn't stop meanwhile
+PASTE_DIRECT_BYTES = 2 * 1024 * 1024
+# clipboard types to ask for, best first; screenshots are nearly always PNG
+PASTE_IMAGE_TYPES = ["image/png", "image/jpeg", "image/webp", "image/bmp", "image/tiff", "image/gif"]
+
+# how far outside the crop area or bubble box drawing can go: crop handles
+# stick out by half their width, and are at least 20px long even when the
+# crop's tiny; bubble handles and the dashed outline stick out a little, as
+# can a bubble's own outline, since line widths don't shrink with the bubble
+CROP_DAMAGE_MARGIN = 26
+BUBBLE_DAMAGE_MARGIN = 8
+
+# what dragging a bubble about is called in the Edit menu, by which part of
+# it was dragged
+BUBBLE_DRAG_EDIT_NAMES = {"move": "Move Bubble", "resize": "Resize Bubble"}
+
 def in_rectangle(point, rect):
     if point.x > rect[0] and point.y > rect[1] and point.x < rect[0]+rect[2] and point.y < rect[1]+rect[3]:
         return True
     return False
 
+def union_rectangle(*rects):
+    left = min(r[0] for r in rects)
+    top = min(r[1] for r in rects)
+    right = max(r[0] + r[2] for r in rects)
+    bottom = max(r[1] + r[3] for r in rects)
+    return (left, top, right - left, bottom - top)
+
+def clip_rectangle(context):
+    """The part of the widget that's actually being redrawn, as x, y, w, h."""
+    x1, y1, x2, y2 = context.clip_extents()
+    return (x1, y1, x2 - x1, y2 - y1)
+
+class Dragger(object):
+    """Mouse drags on a widget. Its press, motion and release handlers are
+       connected once, when it's made, and then:
+       start(event) is called on a press, and returns a move(x, y) function
+           if the press starts a drag, or None if it doesn't;
+       move(x, y) is called with the pointer position, at most once a frame,
+           from the widget's frame clock: a fast mouse or a tablet sends far
+           more motion events than that, and they only note where it's got to;
+       finish(event) is called when the button's let go.
+       """
+    def __init__(self, widget, start, finish=None):
+        self.widget = widget
+        self.start = start
+        self.finish = finish
+        self.move = None # not None while there's a drag going on
+        self.pending = None
+        self.tick_id = None
+        widget.add_events(Gdk.EventMask.BUTTON_MOTION_MASK | Gdk.EventMask.POINTER_MOTION_HINT_MASK |
+            Gdk.EventMask.BUTTON_PRESS_MASK | Gdk.EventMask.BUTTON_RELEASE_MASK)
+        widget.connect("button-press-event", self.pressed)
+        widget.connect("motion-notify-event", self.moved)
+        widget.connect("button-release-event", self.released)
+
+    def pressed(self, widget, event):
+        if self.move: return # another button, in the middle of a drag
+        self.move = self.start(event)
+        if self.move:
+            self.tick_id = widget.add_tick_callback(self.tick)
+
+    def moved(self, widget, event):
+        if self.move: self.pending = (event.x, event.y)
+        # with motion hints on, there isn't another motion event until this
+        # one's been dealt with, so they can't pile up
+        event.request_motions()
+
+    def tick(self, widget, clock):
+        self.apply()
+        return GLib.SOURCE_CONTINUE
+
+    def apply(self):
+        if self.pending:
+            x, y = self.pending
+            self.pending = None
+            self.move(x, y)
+
+    def released(self, widget, event):
+        if not self.move: return
+        self.apply()
+        self.stop()
+        if self.finish: self.finish(event)
+
+    def stop(self):
+        if self.tick_id:
+            self.widget.remove_tick_callback(self.tick_id)
+            self.tick_id = None
+        self.move = None
+        self.pending = None
+
+def queue_draw_rectangle(widget, rect, margin=0):
+    """Redraws just rect (plus margin all round) of widget, rather than all of it."""
+    left = int(math.floor(rect[0] - margin))
+    top = int(math.floor(rect[1] - margin))
+    right = int(math.ceil(rect[0] + rect[2] + margin))
+    bottom = int(math.ceil(rect[1] + rect[3] + margin))
+    widget.queue_draw_area(left, top, right - left, bottom - top)
+
 class Main(object):
 
     ##################################################################
@@ -30,6 +131,28 @@ class Main(object):
         self.window_metrics_restored = False
         self.last_load_dir = GLib.get_user_special_dir(GLib.UserDirectory.DIRECTORY_PICTURES)
         self.img = None
+        self.image_loader = None
+        self.image_refresh_timeout = None
+        self.crop_apply_id = None
+        self.loaded_pixbuf = None
+        self.original_pixbuf = None
+        self.base_key = None
+        self.source_pixbuf = None
+        self.crop_rect = None
+        self.display_borders = None
+        self.pyramid = None
+        self.display_size = None
+        self.display_scale = 1.0
+        self.display_idle = None
+        self.da = None
+        self.bubble_da = None
+        self.history = None
+        self.export = None
+        self.thumbnails = None
+        self.startup_profile = False
+        self.paste_hash = None
+        self.paste_pixbuf = None
+        self.paste_loader = None
 
         # create application
         self.app = Gtk.Application.new("org.kryogenix.graven", 
@@ -38,8 +161,19 @@ class Main(object):
 
     def handle_commandline(self, app, cmdline):
         args = cmdline.get_arguments()[1:]
-        options = [x for x in args if x.startswith("--")]
-        nonoptions = [x for x in args if not x.startswith("--")]
+        options = []
+        nonoptions = []
+        trace_file = None
+        while args:
+            arg = args.pop(0)
+            if arg == "--trace" and args:
+                trace_file = args.pop(0)
+            elif arg.startswith("--trace="):
+                trace_file = arg[len("--trace="):]
+            elif arg.startswith("--"):
+                options.append(arg)
+            else:
+                nonoptions.append(arg)
         if hasattr(self, "w"):
             # already started
             if "--about" in options:
@@ -47,11 +181,15 @@ class Main(object):
                 if nonoptions:
                     self.show_image_path(nonoptions[0])
             return 0
-        self.start_everything_first_time()
+        tracing.setup(trace_file)
+        self.startup_profile = "--startup-profile" in options
+        with tracing.startup.timed("build window"):
+            self.start_everything_first_time()
         if "--about" in options:
             self.show_about_dialog()
         if nonoptions:
-            self.show_image_path(nonoptions[0])
+            with tracing.startup.timed("start loading image"):
+                self.show_image_path(nonoptions[0])
         return 0
 
     def start_everything_first_time(self, on_window_map=None):
@@ -61,9 +199,12 @@ class Main(object):
         self.w = Gtk.ApplicationWindow.new(self.app)
         self.w.set_title("Graven")
         self.w.set_size_request(400, 400)
+        # images are shrunk to fit the window, so start with a decent amount of it
+        self.w.set_default_size(1024, 768)
         self.w.connect("configure-event", self.window_configure)
         self.w.connect("destroy", Gtk.main_quit)
         if on_window_map: self.w.connect("map-event", on_window_map)
+        self.window_mapped_id = self.w.connect("map-event", self.window_mapped)
 
         # the headerbar
         head = Gtk.HeaderBar()
@@ -71,6 +212,23 @@ class Main(object):
         #head.props.title = "Graven"
         self.w.set_titlebar(head)
 
+        self.btnundo = Gtk.Button.new_from_icon_name("edit-undo-symbolic", Gtk.IconSize.BUTTON)
+        self.btnundo.set_action_name("win.undo")
+        head.pack_start(self.btnundo)
+        self.btnredo = Gtk.Button.new_from_icon_name("edit-redo-symbolic", Gtk.IconSize.BUTTON)
+        self.btnredo.set_action_name("win.redo")
+        head.pack_start(self.btnredo)
+        for name, accels, handler in (("undo", ["<Primary>z"], self.undo),
+                ("redo", ["<Primary><Shift>z", "<Primary>y"], self.redo),
+                ("save", ["<Primary>s"], self.save_image),
+                ("paste", ["<Primary>v"], self.paste)):
+            action = Gio.SimpleAction.new(name, None)
+            action.connect("activate", handler)
+            self.w.add_action(action)
+            self.app.set_accels_for_action("win." + name, accels)
+        self.update_undo_actions()
+        self.w.lookup_action("save").set_enabled(False)
+
         self.btncrop = Gtk.ToggleButton.new_with_label("Crop")
         head.pack_start(self.btncrop)
         self.btncrop.connect("clicked", self.crop)
@@ -80,10 +238,19 @@ class Main(object):
         head.pack_start(self.btnbubble)
         self.btnbubble.set_sensitive(False)
 
+        self.btnsave = Gtk.Button.new_with_label("Save")
+        self.btnsave.set_action_name("win.save")
+        head.pack_end(self.btnsave)
+
         self.btnapply = Gtk.Button.new_with_label("Apply")
         head.pack_end(self.btnapply)
         self.btnapply.set_sensitive(False)
 
+        self.loading_progress = Gtk.ProgressBar()
+        self.loading_progress.set_valign(Gtk.Align.CENTER)
+        self.loading_progress.set_no_show_all(True)
+        head.pack_end(self.loading_progress)
+
         self.empty = Gtk.Label()
         self.empty.set_markup('Paste or drag an image, or <a href="#">Open</a> a file')
         self.empty.connect("activate-link", self.open_file)
@@ -97,53 +264,162 @@ class Main(object):
         # and, go
         self.w.show_all()
         GLib.idle_add(self.load_state)
+
+    def window_mapped(self, *args):
+        tracing.startup.mark("window mapped")
+        self.w.disconnect(self.window_mapped_id)
+        clock = self.w.get_frame_clock()
+        self.first_paint_id = clock.connect("after-paint", self.window_first_painted)
+        return False
+
+    def window_first_painted(self, clock):
+        # the window's on screen, so now we can do everything else
+        tracing.startup.mark("first frame")
+        clock.disconnect(self.first_paint_id)
         GLib.idle_add(self.populate_bubble_menu)
 
     def populate_bubble_menu(self):
+        with tracing.startup.timed("import bubble modules"):
+            import bubblelibrary, thumbnails
         bubble_menu_folders = [
             os.path.join(os.path.split(__file__)[0], "..", "bubbles"),
             os.path.join(GLib.get_user_data_dir(), "graven", "bubbles")
         ]
-        bubble_files = []
-        for f in bubble_menu_folders:
-            if os.path.isdir(f):
-                bubble_files += glob.glob(os.path.join(f, "*.bubble.svg"))
-        if not bubble_files:
-            self.btnbubble.destroy()
-            return
-        bubblemenu = Gtk.Menu.new()
-        for f in bubble_files:
-            mi = Gtk.MenuItem.new()
-            pb = GdkPixbuf.Pixbuf.new_from_file_at_size(f, 100, 75)
-            mimg = Gtk.Image.new_from_pixbuf(pb)
-            mi.add(mimg)
-            s2c = svg2cairo.SVG2Cairo()
-            s2c.set_svg_as_filename_async(f) # this will load in the background
-            mi.connect("activate", self.bubble_chosen, s2c)
-            bubblemenu.append(mi)
-        self.btnbubble.set_popup(bubblemenu)
-        bubblemenu.show_all()
-        if self.img:
-            self.btnbubble.set_sensitive(True)
+        self.thumbnails = thumbnails.ThumbnailCache(self.get_thumbnail_folder())
+        self.bubble_library = bubblelibrary.BubbleLibrary(bubble_menu_folders,
+            self.get_bubble_pack_file())
+        with tracing.startup.timed("load bubbles"):
+            self.bubble_library.scan()
+        with tracing.startup.timed("build bubble menu"):
+            self.bubble_menu = Gtk.Menu.new()
+            self.bubble_menu_items = {}
+            for f, entry in self.bubble_library.bubbles.items():
+                self.add_bubble_menu_item(f, entry)
+            self.btnbubble.set_popup(self.bubble_menu)
+            self.bubble_menu.show_all()
+        GLib.idle_add(self.thumbnails.prune)
+        self.update_bubble_button()
+        self.bubble_library.add_listener(self.bubble_library_changed)
+        self.bubble_library.start_monitoring()
+        if self.startup_profile:
+            tracing.startup.report()
+
+    def add_bubble_menu_item(self, f, entry, position=-1):
+        import svg2cairo, thumbnails
+        mi = Gtk.MenuItem.new()
+        s2c = svg2cairo.SVG2Cairo(compiled=True)
+        if entry:
+            s2c.set_pack_entry(entry)
         else:
-            self.btnbubble.set_sensitive(False)
+            # couldn't be packed; try it the slow way
+            s2c.set_svg_as_filename_async(f) # this will load in the background
+        # a placeholder, until the thumbnail turns up
+        mimg = Gtk.Image.new_from_icon_name("image-loading", Gtk.IconSize.DIALOG)
+        mimg.set_size_request(*thumbnails.THUMBNAIL_SIZE)
+        self.thumbnails.request(f, mimg.set_from_pixbuf)
+        mi.add(mimg)
+        mi.connect("activate", self.bubble_chosen, s2c)
+        self.bubble_menu.insert(mi, position)
+        self.bubble_menu_items[f] = mi
+        return mi
+
+    def bubble_library_changed(self, event, f, entry):
+        old = self.bubble_menu_items.pop(f, None)
+        position = -1
+        if old:
+            position = self.bubble_menu.get_children().index(old)
+            old.destroy()
+        if event != "removed":
+            self.add_bubble_menu_item(f, entry, position).show_all()
+        self.update_bubble_button()
+
+    def update_bubble_button(self):
+        self.btnbubble.set_sensitive(bool(self.img and self.image_loader is None and
+            getattr(self, "bubble_menu_items", None)))
 
     def on_drag_data_received(self, widget, drag_context, x,y, data, info, time):
         pb = data.get_pixbuf()
         if pb:
-            print("Got a pixbuf")
+            log.debug("Got a pixbuf")
             Gtk.drag_finish(drag_context, True, False, time)
             self.show_image_pixbuf(pb)
         else:
             uris = data.get_uris()
             if uris and len(uris) == 1:
-                print("Got URIs", uris)
+                log.debug("Got URIs %s", uris)
                 self.show_image_uri(uris[0])
                 Gtk.drag_finish(drag_context, True, False, time)
             else:
-                print ("Got nothing")
+                log.debug("Got nothing")
                 Gtk.drag_finish(drag_context, False, False, time)
 
+    def paste(self, *args):
+        """Pastes an image, or an image file, from the clipboard. It's all
+           asynchronous, so a huge screenshot doesn't hold anything up."""
+        clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
+        clipboard.request_targets(self.got_paste_targets)
+
+    def got_paste_targets(self, clipboard, atoms, *args):
+        names = [atom.name() for atom in atoms or []]
+        log.debug("Clipboard has %s", names)
+        for image_type in PASTE_IMAGE_TYPES:
+            if image_type in names:
+                # the file's own bytes, not a pixbuf, so that a big one can
+                # be decoded a bit at a time, and a repeat spotted before
+                # it's decoded at all
+                clipboard.request_contents(Gdk.Atom.intern(image_type, False), self.got_paste_contents)
+                return
+        if "text/uri-list" in names:
+            clipboard.request_uris(self.got_paste_uris)
+        elif atoms and Gtk.targets_include_image(atoms, False):
+            # some type we don't know, but GdkPixbuf does
+            clipboard.request_image(self.got_paste_image)
+        else:
+            log.info("Nothing on the clipboard to paste")
+
+    def got_paste_contents(self, clipboard, selection_data, *args):
+        import hashlib
+        from gi.repository import GdkPixbuf
+        data = selection_data.get_data()
+        if not data:
+            clipboard.request_image(self.got_paste_image)
+            return
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == self.paste_hash:
+            if self.paste_pixbuf:
+                # pasted this already; no need to decode it again
+                if self.original_pixbuf is not self.paste_pixbuf:
+                    self.show_image_pixbuf(self.paste_pixbuf)
+                return
+            if self.image_loader and self.image_loader is self.paste_loader:
+                return # still loading it from last time
+        self.paste_hash = digest
+        self.paste_pixbuf = None
+        if len(data) > PASTE_DIRECT_BYTES:
+            import imageloader
+            self.paste_loader = self.start_image_loader(imageloader.BytesImageLoader(data,
+                **self.image_loader_callbacks()))
+            return
+        loader = GdkPixbuf.PixbufLoader()
+        try:
+            loader.write(data)
+            loader.close()
+        except GLib.Error as e:
+            log.error("Couldn't paste that image: %s", e.message)
+            self.image_load_failed(e)
+            return
+        self.paste_pixbuf = loader.get_pixbuf()
+        self.show_image_pixbuf(self.paste_pixbuf)
+
+    def got_paste_uris(self, clipboard, uris, *args):
+        if uris:
+            log.debug("Pasted URIs %s", uris)
+            self.show_image_uri(uris[0])
+
+    def got_paste_image(self, clipboard, pb, *args):
+        if pb:
+            self.show_image_pixbuf(pb)
+
     def open_file(self, lbl, uri):
         dialog = Gtk.FileChooserDialog("Please choose a file", self.w,
             Gtk.FileChooserAction.OPEN,
@@ -211,6 +487,12 @@ class Main(object):
     def get_cache_file(self):
         return os.path.join(GLib.get_user_cache_dir(), "graven.json")
 
+    def get_bubble_pack_file(self):
+        return os.path.join(GLib.get_user_cache_dir(), "graven", "bubbles.pack")
+
+    def get_thumbnail_folder(self):
+        return os.path.join(GLib.get_user_cache_dir(), "graven", "thumbnails")
+
     def serialise(self, *args, **kwargs):
         # yeah, yeah, supposed to use Gio's async file stuff here. But it was writing
         # corrupted files, and I have no idea why; probably the Python var containing
@@ -237,7 +519,7 @@ class Main(object):
             if "last_load_dir" in data:
                 self.last_load_dir = data.get("last_load_dir")
         except Exception as e:
-            print("Failed to restore data")
+            log.error("Failed to restore data: %s", e)
             raise
 
     def load_state(self):
@@ -250,28 +532,173 @@ class Main(object):
     ##################################################################
 
     def show_image_uri(self, uri):
-        f = Gio.File.new_for_uri(uri)
-        self.show_image_path(f.get_path())
+        self.load_image(Gio.File.new_for_uri(uri))
 
     def show_image_path(self, path):
-        img = Gtk.Image.new_from_file(path)
-        pb = img.get_pixbuf()
-        self.show_image_pixbuf(pb)
+        self.load_image(Gio.File.new_for_path(path))
+
+    def load_image(self, f):
+        import imageloader
+        self.start_image_loader(imageloader.ImageLoader(f, **self.image_loader_callbacks()))
+
+    def image_loader_callbacks(self):
+        return {"prepared": self.set_image_pixbuf, "updated": self.image_load_updated,
+            "progress": self.image_load_progress, "finished": self.image_loaded,
+            "failed": self.image_load_failed}
+
+    def start_image_loader(self, loader):
+        """Loads an image a chunk at a time, showing it as it arrives. Loading
+           or pasting something else in the meantime cancels this."""
+        self.cancel_image_load()
+        self.cancel_export()
+        self.image_loader = loader
+        self.loading_progress.set_fraction(0)
+        self.loading_progress.show()
+        self.image_loader.start()
+        return loader
+
+    def cancel_image_load(self):
+        if self.image_loader:
+            self.image_loader.cancel()
+            self.finish_image_load()
+
+    def finish_image_load(self):
+        self.image_loader = None
+        self.paste_loader = None
+        self.loading_progress.hide()
+        if self.image_refresh_timeout:
+            GLib.source_remove(self.image_refresh_timeout)
+            self.image_refresh_timeout = None
+
+    def image_load_updated(self, pb, x, y, width, height):
+        # the canvas shows a scaled copy of the image, which has to be made
+        # again to see the newly decoded bits; only do that a few times a second
+        if self.image_refresh_timeout: return
+        self.image_refresh_timeout = GLib.timeout_add(250, self.refresh_loading_image)
+
+    def refresh_loading_image(self):
+        self.image_refresh_timeout = None
+        self.update_display(force=True)
+        return False
+
+    def image_load_progress(self, fraction):
+        if fraction is None:
+            self.loading_progress.pulse()
+        else:
+            self.loading_progress.set_fraction(fraction)
+
+    def image_loaded(self, pb):
+        if self.image_loader and self.image_loader is self.paste_loader:
+            self.paste_pixbuf = pb
+        self.finish_image_load()
+        tracing.startup.mark("image loaded")
+        if self.original_pixbuf is pb:
+            self.update_display(force=True)
+            self.image_complete()
+        else:
+            self.set_image_pixbuf(pb)
+
+    def image_load_failed(self, error):
+        self.finish_image_load()
+        if not self.img:
+            self.empty.set_markup("Couldn't open that image (%s). Paste or drag an image, "
+                'or <a href="#">Open</a> a file' % (GLib.markup_escape_text(error.message),))
 
     def show_image_pixbuf(self, pb):
-        self.img = Gtk.Image.new_from_pixbuf(pb)
+        self.cancel_image_load()
+        self.cancel_export()
+        self.set_image_pixbuf(pb)
+
+    def set_image_pixbuf(self, pb):
+        """Shows pb, which might still be loading. pb itself is never changed:
+           cropping just records a crop_rect, and source_pixbuf is a view of
+           that part of pb. The canvas shows a copy scaled to fit."""
+        import imageops, history
+        if self.original_pixbuf:
+            self.remove_crop_mode()
+            self.remove_bubble_overlay()
+        # the same budget however big the image is; an Apply that's been
+        # thrown out of it is just flattened again if it's undone back to
+        self.history = history.History(render_budget=history.configured_render_budget())
+        self.update_undo_actions()
+        self.loaded_pixbuf = pb
+        self.base_key = None
+        self.original_pixbuf = pb
+        self.crop_rect = copy.deepcopy(imageops.FULL_IMAGE)
+        self.display_borders = self.crop_rect
+        self.source_pixbuf = pb
+        self.pyramid = None
+        self.display_size = None
+        self.img = Gtk.Image.new()
         self.show_image()
+        self.update_display()
+        if self.image_loader is None:
+            self.image_complete()
+
+    def image_complete(self):
+        import pyramid
+        self.btncrop.set_sensitive(True)
+        self.update_bubble_button()
+        self.w.lookup_action("save").set_enabled(True)
+        pyramid.build_async(self.original_pixbuf, self.pyramid_built)
+
+    def pyramid_built(self, pyr):
+        if pyr.source is not self.original_pixbuf: return # a different image by now
+        self.pyramid = pyr
+        self.update_display(force=True)
 
     def show_image(self):
         if self.img:
-            print("showing image")
+            log.debug("showing image")
             self.w.remove(self.w.get_children()[0])
             self.fixed = Gtk.Fixed()
+            self.fixed.set_halign(Gtk.Align.CENTER)
+            self.fixed.set_valign(Gtk.Align.CENTER)
             self.fixed.add(self.img)
-            self.w.add(self.fixed)
-            self.fixed.show_all()
-            self.btncrop.set_sensitive(True)
-            self.btnbubble.set_sensitive(True)
+            # scrollable only so that the window can be made smaller than the
+            # image is at the moment; the image is then shrunk to fit again
+            self.canvas = Gtk.ScrolledWindow()
+            self.canvas.add(self.fixed)
+            self.canvas.connect("size-allocate", self.canvas_resized)
+            self.w.add(self.canvas)
+            self.canvas.show_all()
+            # no cropping or bubbling half an image
+            self.btncrop.set_sensitive(self.image_loader is None)
+            self.update_bubble_button()
+
+    def canvas_resized(self, canvas, alloc):
+        # can't resize things in the middle of a size-allocate, so do it next
+        if not self.display_idle:
+            self.display_idle = GLib.idle_add(self.update_display)
+
+    @tracing.traced("image.display")
+    def update_display(self, force=False):
+        """Puts a copy of the display_borders part of the image on the canvas,
+           at the right size to fit. That's the cropped image, or all of it
+           while cropping."""
+        import pyramid, imageops
+        self.display_idle = None
+        pb = self.original_pixbuf
+        alloc = self.canvas.get_allocation()
+        if alloc.width > 1:
+            available = (alloc.width, alloc.height)
+        else:
+            available = self.w.get_size() # not allocated yet; this is near enough
+        x, y, view_width, view_height = imageops.crop_area(pb, self.display_borders)
+        width, height, scale = pyramid.fit(view_width, view_height, *available)
+        if (width, height) == self.display_size and not force: return False
+        if self.pyramid:
+            proxy = self.pyramid.scaled(width, height, self.display_borders)
+        else:
+            # still loading, or the pyramid isn't built yet
+            proxy = pyramid.preview(imageops.crop_view(pb, self.display_borders), width, height)
+        self.img.set_from_pixbuf(proxy)
+        self.display_size = (width, height)
+        self.display_scale = float(width) / view_width
+        for da in (self.da, self.bubble_da):
+            if da: da.set_size_request(width, height)
+        if self.bubble_da: self.update_bubble_scene()
+        return False
 
     def crop(self, btn):
         if btn.get_active():
@@ -280,11 +707,20 @@ class Main(object):
             self.remove_crop_mode()
 
     def draw_crop_mode(self):
-        alloc = self.fixed.get_allocation()
+        import imageops
+        # show the whole image while cropping, so the crop can be made bigger
+        # again as well as smaller
+        self.display_borders = imageops.FULL_IMAGE
+        self.update_display(force=True)
+        # the bubble overlay is laid out over the cropped image, not the
+        # whole one, so it's put away until the crop's done; and Apply means
+        # "apply the crop" for now
+        if self.bubble_da:
+            self.bubble_da.hide()
+            self.btnapply.handler_block(self.bubble_apply_id)
         self.da = Gtk.DrawingArea()
-        self.da.set_size_request(alloc.width, alloc.height)
-        self.da.set_events(Gdk.EventMask.BUTTON_MOTION_MASK | 
-            Gdk.EventMask.BUTTON_PRESS_MASK | Gdk.EventMask.BUTTON_RELEASE_MASK)
+        self.da.set_size_request(*self.display_size)
+        self.crop_dragger = Dragger(self.da, self.crop_mousedown)
         self.fixed.add(self.da)
         self.da.show_all()
         self.crop_apply_id = self.btnapply.connect("clicked", self.crop_apply)
@@ -292,35 +728,31 @@ class Main(object):
         self.handle_rectangles = []
         self.crop_rectangle = (-1, -1, -1, -1)
 
-        self.crop_borders = [[0.3,0.3], [0.75,0.55]]
-        self.crop_mousedown_id = self.da.connect("button-press-event", self.crop_mousedown)
-        self.crop_mouseup_id = self.da.connect("button-release-event", self.crop_mouseup)
+        if self.crop_rect == imageops.FULL_IMAGE:
+            self.crop_borders = [[0.3,0.3], [0.75,0.55]]
+        else:
+            self.crop_borders = copy.deepcopy(self.crop_rect)
         self.da.connect("draw", self.actually_draw_crop)
         self.da.queue_draw()
 
     def crop_apply(self, btn):
-        pb = self.img.get_pixbuf()
-        w = pb.get_width()
-        h = pb.get_height()
-        print("apply crop", self.crop_borders)
-
-        sub_tl = (int(self.crop_borders[0][0] * w), int(self.crop_borders[0][1] * h))
-        sub_br = (int(self.crop_borders[1][0] * w), int(self.crop_borders[1][1] * h))
-        sub_w = int(sub_br[0] - sub_tl[0])
-        sub_h = int(sub_br[1] - sub_tl[1])
-
-        new_pb = GdkPixbuf.Pixbuf.new(pb.get_colorspace(), pb.get_has_alpha(), pb.get_bits_per_sample(), sub_w, sub_h)
-
-        pb.copy_area(sub_tl[0], sub_tl[1], sub_w, sub_h, new_pb, 0, 0)
-
+        import imageops, history
+        log.debug("apply crop %s", self.crop_borders)
+        # crop_borders is in fractions of the whole image, because that's
+        # what crop mode shows, so it's the new crop_rect as it is; nothing's
+        # copied, and the rest of the image is still there to crop back out to
+        self.history.do(history.Crop(imageops.clamp_borders(self.crop_borders)))
+        with tracing.span("image.crop"):
+            self.apply_edit_state()
         self.remove_crop_mode()
-        print("apply")
-        self.show_image_pixbuf(new_pb)
 
+    @tracing.traced("draw.crop")
     def actually_draw_crop(self, da, context):
-        surface = context.get_target()
-        w = surface.get_width()
-        h = surface.get_height()
+        import cairo
+        # the widget's size, not the target's: when only part of it is being
+        # redrawn, the target can be just big enough for that part
+        w = da.get_allocated_width()
+        h = da.get_allocated_height()
         context.set_source_rgba(0, 0, 0, 0.6)
         context.set_line_width(3)
 
@@ -331,11 +763,13 @@ class Main(object):
         cw = brx-tlx
         ch = bry-tly
         self.crop_rectangle = (tlx, tly, cw, ch)
-        context.rectangle(0, 0, tlx, h)
-        context.rectangle(brx, 0, w, h)
-        context.rectangle(0, 0, w, tly)
-        context.rectangle(0, bry, w, h)
+        # shade everything outside the crop, but only as much of it as is
+        # being redrawn, which while dragging is usually a thin strip
+        context.rectangle(*clip_rectangle(context))
+        context.rectangle(tlx, tly, cw, ch)
+        context.set_fill_rule(cairo.FILL_RULE_EVEN_ODD)
         context.fill()
+        context.set_fill_rule(cairo.FILL_RULE_WINDING)
 
         # handles
         handle_width = 6 # must be even
@@ -354,65 +788,75 @@ class Main(object):
         context.fill()
 
     def remove_crop_mode(self):
-        print("remove crop")
-        self.btnapply.set_sensitive(False)
-        self.btncrop.set_active(False)
-        self.da.disconnect(self.crop_mousedown_id)
-        self.da.disconnect(self.crop_mouseup_id)
+        # unsetting the Crop button calls this again, so only do it once
+        if not self.crop_apply_id: return
+        log.debug("remove crop")
         self.btnapply.disconnect(self.crop_apply_id)
+        self.crop_apply_id = None
+        self.btnapply.set_sensitive(bool(self.bubble_da))
+        self.btncrop.set_active(False)
+        self.crop_dragger.stop()
+        self.crop_dragger = None
         self.da.destroy()
-
-    def crop_mousedown(self, widget, event):
-        in_handle = False
+        self.da = None
+        self.display_borders = self.crop_rect
+        self.update_display(force=True)
+        if self.bubble_da:
+            self.btnapply.handler_unblock(self.bubble_apply_id)
+            self.bubble_da.show()
+
+    def crop_mousedown(self, event):
+        alloc = self.da.get_allocation()
+        self.surface_w = alloc.width
+        self.surface_h = alloc.height
         for r, loc in self.handle_rectangles:
             if in_rectangle(event, r):
-                print("crop md IN", loc)
-                in_handle = True
-                if loc == "tl":
-                    self.crop_mousemove_id = self.da.connect("motion-notify-event", self.crop_mm_tl)
-                    print("Set crop mm to tl", self.crop_mousemove_id)
-                else:
-                    self.crop_mousemove_id = self.da.connect("motion-notify-event", self.crop_mm_br)
-                    print("Set crop mm to br", self.crop_mousemove_id)
-                alloc = widget.get_allocation()
-                self.surface_w = alloc.width
-                self.surface_h = alloc.height
-                break
-        if not in_handle:
-            if in_rectangle(event, self.crop_rectangle):
-                print("crop md IN CROP")
-                alloc = widget.get_allocation()
-                self.surface_w = alloc.width
-                self.surface_h = alloc.height
-                self.move_original_x = event.x
-                self.move_original_y = event.y
-                self.original_crop_rectangle = copy.copy(self.crop_rectangle)
-                self.crop_mousemove_id = self.da.connect("motion-notify-event", self.crop_mm_crop)
-            else:
-                print("crop md NOWHERE", event.x, event.y)
-    def crop_mm_tl(self, widget, event):
-        new_tl = [event.x / self.surface_w, event.y / self.surface_h]
+                log.debug("crop mousedown in handle %s", loc)
+                return self.crop_mm_tl if loc == "tl" else self.crop_mm_br
+        if in_rectangle(event, self.crop_rectangle):
+            log.debug("crop mousedown in crop area")
+            self.move_original_x = event.x
+            self.move_original_y = event.y
+            self.original_crop_rectangle = copy.copy(self.crop_rectangle)
+            return self.crop_mm_crop
+        return None
+
+    def crop_canvas_rectangle(self):
+        """The crop area, as x, y, w, h in crop overlay pixels."""
+        tl, br = self.crop_borders
+        return (tl[0] * self.surface_w, tl[1] * self.surface_h,
+            (br[0] - tl[0]) * self.surface_w, (br[1] - tl[1]) * self.surface_h)
+
+    def crop_damaged(self, old):
+        """Redraws the part of the overlay the crop has moved out of and into."""
+        queue_draw_rectangle(self.da, union_rectangle(old, self.crop_canvas_rectangle()),
+            CROP_DAMAGE_MARGIN)
+
+    def crop_mm_tl(self, x, y):
+        new_tl = [x / self.surface_w, y / self.surface_h]
 
         # You can't crop to less than a tenth of the image
         if (self.crop_borders[1][0] - new_tl[0] < 0.1): return
         if (self.crop_borders[1][1] - new_tl[1] < 0.1): return
 
+        old = self.crop_canvas_rectangle()
         self.crop_borders[0] = new_tl
-        self.da.queue_draw()
+        self.crop_damaged(old)
 
-    def crop_mm_br(self, widget, event):
-        new_tl = [event.x / self.surface_w, event.y / self.surface_h]
+    def crop_mm_br(self, x, y):
+        new_tl = [x / self.surface_w, y / self.surface_h]
 
         # You can't crop to less than a tenth of the image
         if (new_tl[0] - self.crop_borders[0][0] < 0.1): return
         if (new_tl[1] - self.crop_borders[0][1] < 0.1): return
 
+        old = self.crop_canvas_rectangle()
         self.crop_borders[1] = new_tl
-        self.da.queue_draw()
+        self.crop_damaged(old)
 
-    def crop_mm_crop(self, widget, event):
-        dx = event.x - self.move_original_x
-        dy = event.y - self.move_original_y
+    def crop_mm_crop(self, x, y):
+        dx = x - self.move_original_x
+        dy = y - self.move_original_y
         new_crop = [
             self.original_crop_rectangle[0] + dx,
             self.original_crop_rectangle[1] + dy,
@@ -422,87 +866,166 @@ class Main(object):
 
         tl = [new_crop[0]/self.surface_w, new_crop[1]/self.surface_h]
         br = [new_crop[2]/self.surface_w, new_crop[3]/self.surface_h]
+        old = self.crop_canvas_rectangle()
         self.crop_borders = [tl, br]
-        self.da.queue_draw()
-
-    def crop_mouseup(self, *args):
-        if hasattr(self, "crop_mousemove_id"): self.da.disconnect(self.crop_mousemove_id)
+        self.crop_damaged(old)
 
     def bubble_chosen(self, mi, s2c):
-        print("bubble chosen", s2c)
-
-        alloc = self.fixed.get_allocation()
-        self.da = Gtk.DrawingArea()
-        self.da.set_size_request(alloc.width, alloc.height)
-        self.da.set_events(Gdk.EventMask.BUTTON_MOTION_MASK | 
-            Gdk.EventMask.BUTTON_PRESS_MASK | Gdk.EventMask.BUTTON_RELEASE_MASK)
-        self.fixed.add(self.da)
-
-        self.bubble_tl_br_box = [alloc.width * 0.6, alloc.height * 0.3, alloc.width * 0.8, alloc.height * 0.5]
-        self.bubble_text = "LOL"
-
-        self.da.show_all()
+        import history
+        log.debug("bubble chosen %s", s2c)
+        # like crop_borders, boxes are in fractions of the image, so that
+        # they don't care what size the image is shown at
+        self.history.do(history.AddBubble(s2c, [0.6, 0.3, 0.8, 0.5], "LOL"))
+        self.apply_edit_state()
+
+    def show_bubble_overlay(self):
+        import sprites, scene
+        self.bubble_sprites = sprites.SpriteCache(BUBBLE_DAMAGE_MARGIN)
+        self.bubble_scene = scene.Scene()
+        self.bubble_selected = None
+        self.bubble_count = 0
+        self.bubble_da = Gtk.DrawingArea()
+        self.bubble_da.set_size_request(*self.display_size)
+        self.bubble_dragger = Dragger(self.bubble_da, self.bubble_mousedown, self.bubble_mouseup)
+        self.fixed.add(self.bubble_da)
+        self.bubble_da.show_all()
         self.bubble_apply_id = self.btnapply.connect("clicked", self.bubble_apply)
+        if self.crop_apply_id:
+            # crop mode unblocks it when it's done
+            self.bubble_da.hide()
+            self.btnapply.handler_block(self.bubble_apply_id)
         self.btnapply.set_sensitive(True)
-        self.bubble_resize_handle_rectangles = []
-        self.bubble_mousedown_id = self.da.connect("button-press-event", self.bubble_mousedown)
-        self.da.connect("draw", self.actually_draw_bubble, s2c)
-        self.da.queue_draw()
+        self.bubble_da.connect("draw", self.actually_draw_bubble)
 
-    def bubble_mousedown(self, widget, event):
-        print("bb md", event.x, event.y, event.time)
+    def remove_bubble_overlay(self):
+        if not self.bubble_da: return
+        self.btnapply.disconnect(self.bubble_apply_id)
+        self.btnapply.set_sensitive(False)
+        self.bubble_dragger.stop()
+        self.bubble_dragger = None
+        self.bubble_sprites.clear()
+        self.bubble_da.destroy()
+        self.bubble_da = None
+
+    def bubble_mousedown(self, event):
         self.bubble_clicked_event_details = (event.x, event.y, event.time)
-        in_resize = False
-        for r, loc in self.bubble_resize_handle_rectangles:
-            if in_rectangle(event, r):
-                print("bubble md IN RESIZE", loc)
-                self.disconnects = []
-                self.disconnects.append(self.da.connect("motion-notify-event", self.bubble_mm_resize, loc))
-                self.disconnects.append(self.da.connect("button-release-event", self.bubble_mouseup))
-                in_resize = True
-                break
-        if not in_resize:
-            bbox = (self.bubble_tl_br_box[0], self.bubble_tl_br_box[1], 
-                self.bubble_tl_br_box[2]-self.bubble_tl_br_box[0],
-                self.bubble_tl_br_box[3]-self.bubble_tl_br_box[1])
-            if in_rectangle(event, bbox):
-                print("bubble md IN RESIZE", loc)
-                self.disconnects = []
-                self.disconnects.append(self.da.connect("motion-notify-event", self.bubble_mm_move, (copy.copy(self.bubble_tl_br_box), event.x, event.y)))
-                self.disconnects.append(self.da.connect("button-release-event", self.bubble_mouseup))
-
-    def bubble_mm_move(self, widget, event, data):
+        self.bubble_newly_selected = False
+        hit = self.bubble_scene.hit(event.x, event.y)
+        if not hit: return None
+        kind, which = hit
+        if kind == "handle":
+            log.debug("bubble mousedown in resize handle %s", which)
+            self.bubble_drag_kind = "resize"
+            return lambda x, y: self.bubble_mm_resize(x, y, which)
+        log.debug("bubble mousedown in bubble %s", which)
+        if which != self.bubble_selected:
+            self.select_bubble(which)
+            self.bubble_newly_selected = True
+        self.bubble_drag_kind = "move"
+        original = (copy.copy(self.bubble_tl_br_box), event.x, event.y)
+        return lambda x, y: self.bubble_mm_move(x, y, original)
+
+    def select_bubble(self, index):
+        """Makes bubble index the one being edited (the one with handles)."""
+        bubble = self.history.state.bubbles[index]
+        self.bubble_selected = index
+        self.bubble_tl_br_box = list(bubble.box)
+        self.bubble_text = bubble.text
+        self.update_bubble_scene()
+        self.bubble_da.queue_draw()
+
+    def update_bubble_scene(self):
+        """Puts every bubble in the scene where it is on the canvas now."""
+        rects = [self.bubble_canvas_rectangle(bubble.box) for bubble in self.history.state.bubbles]
+        if self.bubble_selected is not None:
+            rects[self.bubble_selected] = self.bubble_canvas_rectangle()
+        self.bubble_scene.set_bubbles(rects)
+        if self.bubble_selected is not None:
+            self.bubble_scene.set_handles(self.bubble_handle_rectangles(rects[self.bubble_selected]))
+
+    def bubble_handle_rectangles(self, bbox):
+        """The resize handles for a bubble at bbox, as (rect, "tl" or "br")."""
+        handle_width = 6 # must be even
+        handle_length = min(bbox[2]/6, bbox[3]/6)
+        right = bbox[0] + bbox[2]
+        bottom = bbox[1] + bbox[3]
+        return (
+            ((bbox[0] - (handle_width/2), bbox[1] - (handle_width/2), 
+                handle_length, handle_width), "tl"), # horizontal tl
+            ((bbox[0] - (handle_width/2), bbox[1] - (handle_width/2), 
+                handle_width, handle_length), "tl"), # vertical tl
+            ((right - handle_length + (handle_width/2),
+              bottom - (handle_width/2),
+              handle_length, handle_width), "br"), # horizontal br
+            ((right - (handle_width/2),
+              bottom - handle_length + (handle_width/2),
+              handle_width, handle_length), "br") # vertical br
+        )
+
+    def bubble_canvas_box(self, box=None):
+        """A bubble's box (by default, the one being edited), in canvas pixels."""
+        w, h = self.display_size
+        b = box or self.bubble_tl_br_box
+        return [b[0] * w, b[1] * h, b[2] * w, b[3] * h]
+
+    def bubble_canvas_rectangle(self, box=None):
+        """The same, as x, y, w, h."""
+        tlbr = self.bubble_canvas_box(box)
+        return (tlbr[0], tlbr[1], tlbr[2]-tlbr[0], tlbr[3]-tlbr[1])
+
+    def bubble_damaged(self, old):
+        """Redraws where the bubble being edited was, and where it is now."""
+        new = self.bubble_canvas_rectangle()
+        self.bubble_scene.move_bubble(self.bubble_selected, new)
+        self.bubble_scene.set_handles(self.bubble_handle_rectangles(new))
+        queue_draw_rectangle(self.bubble_da, union_rectangle(old, new), BUBBLE_DAMAGE_MARGIN)
+
+    def bubble_mm_move(self, x, y, data):
         original_tlbr, startx, starty = data
-        dx = event.x - startx
-        dy = event.y - starty
+        dx = (x - startx) / self.display_size[0]
+        dy = (y - starty) / self.display_size[1]
+        old = self.bubble_canvas_rectangle()
         self.bubble_tl_br_box = [
             original_tlbr[0] + dx,
             original_tlbr[1] + dy,
             original_tlbr[2] + dx,
             original_tlbr[3] + dy
         ]
-        self.da.queue_draw()
+        self.bubble_damaged(old)
 
-    def bubble_mm_resize(self, widget, event, resize_dir):
+    def bubble_mm_resize(self, x, y, resize_dir):
+        x = x / self.display_size[0]
+        y = y / self.display_size[1]
+        old = self.bubble_canvas_rectangle()
         if resize_dir == "tl":
-            self.bubble_tl_br_box[0] = event.x
-            self.bubble_tl_br_box[1] = event.y
+            self.bubble_tl_br_box[0] = x
+            self.bubble_tl_br_box[1] = y
         elif resize_dir == "br":
-            self.bubble_tl_br_box[2] = event.x
-            self.bubble_tl_br_box[3] = event.y
-        print("bb resize", resize_dir, event.x, event.y, self.bubble_tl_br_box)
-        self.da.queue_draw()
-
-    def bubble_mouseup(self, widget, event, mousemove_unbind_id=None):
-        print("bb mu")
-        for eid in self.disconnects: self.da.disconnect(eid)
+            self.bubble_tl_br_box[2] = x
+            self.bubble_tl_br_box[3] = y
+        self.bubble_damaged(old)
+
+    def bubble_mouseup(self, event):
+        import history
+        # anything drawn from a sprite during the drag gets drawn properly again
+        self.bubble_da.queue_draw()
         dx = abs(event.x - self.bubble_clicked_event_details[0])
         dy = abs(event.y - self.bubble_clicked_event_details[1])
         dt = event.time - self.bubble_clicked_event_details[2]
+        box = self.history.state.bubbles[self.bubble_selected].box
         if (dx < 2 and dy < 2 and dt < 100):
-            self.bubble_clicked()
+            self.bubble_tl_br_box = list(box)
+            self.update_bubble_scene()
+            # clicking a bubble picks it; clicking it again edits its text
+            if not self.bubble_newly_selected: self.bubble_clicked()
+        elif tuple(self.bubble_tl_br_box) != box:
+            # one edit for the whole drag, not one per mouse movement
+            self.history.do(history.SetBubbleBox(self.bubble_selected,
+                self.bubble_tl_br_box, BUBBLE_DRAG_EDIT_NAMES[self.bubble_drag_kind]))
+            self.apply_edit_state()
 
     def bubble_clicked(self):
+        import history
         dia = Gtk.Dialog.new()
         dia.set_modal(True)
         dia.add_buttons("_OK", 0, "Cancel", 1)
@@ -520,57 +1043,217 @@ class Main(object):
         c.pack_start(tv,True, True, 6)
         c.show_all()
         response = dia.run()
-        print("response", response)
-        if response == Gtk.ResponseType.DELETE_EVENT:
-            print("closed")
-        elif response == 1:
-            print("cancelled")
-        elif response == 0:
+        log.debug("bubble text dialog response %s", response)
+        if response == 0:
             bounds = buf.get_bounds()
-            self.bubble_text = buf.get_text(bounds[0], bounds[1], False)
-            print("ok")
-        else:
-            print("something else")
+            text = buf.get_text(bounds[0], bounds[1], False)
+            if text != self.bubble_text:
+                self.history.do(history.SetBubbleText(self.bubble_selected, text))
+                self.apply_edit_state()
         dia.destroy()
 
     def bubble_apply(self, btn):
-        print("bb apply")
-    def actually_draw_bubble(self, da, context, s2c):
-        print("draw", self.bubble_tl_br_box)
-        # bubble_tl_br_box holds coordinates; make a standard x,y,w,h box
-        bbox = (self.bubble_tl_br_box[0], self.bubble_tl_br_box[1], 
-            self.bubble_tl_br_box[2]-self.bubble_tl_br_box[0],
-            self.bubble_tl_br_box[3]-self.bubble_tl_br_box[1])
-        print("bbox", bbox)
-        details = s2c.render_to_context_at_size_with_text(context, 
-            bbox[0], bbox[1], bbox[2], bbox[3], self.bubble_text, "Impact")
+        """Flattens the crop and the bubbles into the image. It's an edit
+           like any other, so it can be undone."""
+        log.debug("bubble apply")
+        self.start_export(None)
+
+    ##################################################################
+    # Exporting
+    ##################################################################
+
+    def save_image(self, *args):
+        dialog = Gtk.FileChooserDialog("Save image", self.w,
+            Gtk.FileChooserAction.SAVE,
+            (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+             Gtk.STOCK_SAVE, Gtk.ResponseType.OK))
+        dialog.set_do_overwrite_confirmation(True)
+        dialog.set_current_folder(self.last_load_dir)
+        dialog.set_current_name("graven.png")
+        response = dialog.run()
+        filename = dialog.get_filename()
+        dialog.destroy()
+        if response == Gtk.ResponseType.OK:
+            self.start_export(filename)
+
+    def start_export(self, filename):
+        """Exports the image as it is now, in the background: to filename, or,
+           if that's None, to a new pixbuf which replaces the image."""
+        import export
+        self.cancel_export()
+        try:
+            self.export = export.Export(self.original_pixbuf, self.history.state, filename,
+                progress=self.export_progress, finished=self.export_finished,
+                failed=self.export_failed)
+        except Exception as e:
+            self.export_failed(str(e))
+            return
+        self.export_state = self.history.state
+        self.btnapply.set_sensitive(False)
+        self.loading_progress.set_fraction(0)
+        self.loading_progress.show()
+        self.export.start()
+
+    def cancel_export(self):
+        if self.export:
+            self.export.cancel()
+            self.finish_export()
+
+    def finish_export(self):
+        self.export = None
+        self.loading_progress.hide()
+        self.btnapply.set_sensitive(bool(self.bubble_da or self.crop_apply_id))
+
+    def export_progress(self, fraction):
+        self.loading_progress.set_fraction(fraction)
+
+    def export_finished(self, result):
+        self.finish_export()
+        if isinstance(result, str):
+            log.info("Saved %s", result)
+        elif self.history.state is not self.export_state:
+            # states are never changed, only replaced, so any edit, undo or
+            # redo since (even one back to the same position) makes a new one
+            log.debug("Edited while flattening; not applying a stale flatten")
+        else:
+            self.record_apply(result)
+
+    def record_apply(self, pb):
+        import history
+        position = self.history.position
+        self.history.cache_render(("flatten", position), pb)
+        self.set_base(position, pb)
+        self.history.do(history.Flatten(position))
+        self.apply_edit_state()
+
+    def base_pixbuf(self, state):
+        """The picture state's crop and bubbles go on: the loaded image, or
+           what an Apply made, from the history's render cache (or made
+           again, if it's been thrown out)."""
+        if state.base is None: return self.loaded_pixbuf
+        return self.history.render("flatten", self.flatten_state, state.base)
+
+    def flatten_state(self, state):
+        import export
+        log.debug("Flattening again for undo or redo")
+        return export.Export(self.base_pixbuf(state), state).export()
+
+    def set_base(self, key, pb):
+        """Makes pb the picture the edits apply to, without touching the history."""
+        import pyramid
+        self.base_key = key
+        self.original_pixbuf = pb
+        self.crop_rect = None # so apply_edit_state makes a new view of it
+        self.pyramid = None
+        pyramid.build_async(pb, self.pyramid_built)
+
+    def export_failed(self, message):
+        self.finish_export()
+        dialog = Gtk.MessageDialog(transient_for=self.w, modal=True,
+            message_type=Gtk.MessageType.ERROR, buttons=Gtk.ButtonsType.CLOSE,
+            text="Couldn't export the image")
+        dialog.format_secondary_text(message)
+        dialog.run()
+        dialog.destroy()
+
+    @tracing.traced("draw.bubble")
+    def actually_draw_bubble(self, da, context):
+        bubbles = self.history.state.bubbles
+        clip = clip_rectangle(context)
+        dragging = bool(self.bubble_dragger.move)
+        # only draw the bubbles in the bit being redrawn, which while dragging
+        # is usually not much; they come back bottom first
+        area = (clip[0] - BUBBLE_DAMAGE_MARGIN, clip[1] - BUBBLE_DAMAGE_MARGIN,
+            clip[2] + BUBBLE_DAMAGE_MARGIN * 2, clip[3] + BUBBLE_DAMAGE_MARGIN * 2)
+        for index in self.bubble_scene.bubbles_in(area):
+            if index == self.bubble_selected:
+                # the edited bubble might be being dragged, so it's drawn
+                # where it's got to. Its size doesn't change while it's
+                # moved, but it does while it's resized, so a sprite would
+                # be no use then
+                self.draw_one_bubble(context, dragging and self.bubble_drag_kind == "move",
+                    bubbles[index], self.bubble_canvas_rectangle(), self.bubble_text)
+            else:
+                self.draw_one_bubble(context, dragging, bubbles[index],
+                    self.bubble_canvas_rectangle(bubbles[index].box), bubbles[index].text)
+
+        if self.bubble_selected is None: return
+        bbox = self.bubble_canvas_rectangle()
         context.rectangle(*bbox)
         context.set_line_width(2)
         context.set_source_rgba(255, 0, 0, 0.9)
         context.set_dash([5])
         context.stroke()
 
-        handle_width = 6 # must be even
-        handle_length = min(bbox[2]/6, bbox[3]/6)
-        self.bubble_resize_handle_rectangles = (
-            ((bbox[0] - (handle_width/2), bbox[1] - (handle_width/2), 
-                handle_length, handle_width), "tl"), # horizontal tl
-            ((bbox[0] - (handle_width/2), bbox[1] - (handle_width/2), 
-                handle_width, handle_length), "tl"), # vertical tl
-            ((self.bubble_tl_br_box[2] - handle_length + (handle_width/2),
-              self.bubble_tl_br_box[3] - (handle_width/2),
-              handle_length, handle_width), "br"), # horizontal br
-            ((self.bubble_tl_br_box[2] - (handle_width/2),
-              self.bubble_tl_br_box[3] - handle_length + (handle_width/2),
-              handle_width, handle_length), "br") # vertical br
-        )
         context.set_source_rgba(0, 128, 0, 1)
-        for r, loc in self.bubble_resize_handle_rectangles:
+        for r, loc in self.bubble_handle_rectangles(bbox):
             context.rectangle(*r)
         context.fill()
 
+    def draw_one_bubble(self, context, from_sprite, bubble, bbox, text):
+        """Draws a bubble into bbox, properly or (quicker, but softer) from a sprite."""
+        if from_sprite:
+            self.bubble_sprites.draw(context, bubble.s2c, bbox[0], bbox[1], bbox[2], bbox[3],
+                text, bubble.font, self.bubble_da.get_scale_factor())
+        else:
+            bubble.s2c.render_to_context_at_size_with_text(context,
+                bbox[0], bbox[1], bbox[2], bbox[3], text, bubble.font)
+
+    ##################################################################
+    # Undo and redo
+    ##################################################################
+
+    def apply_edit_state(self):
+        """Makes what's on screen match the history's current state."""
+        import imageops
+        state = self.history.state
+        if state.base != self.base_key:
+            self.set_base(state.base, self.base_pixbuf(state))
+        crop_rect = [list(corner) for corner in state.crop_rect]
+        if crop_rect != self.crop_rect:
+            self.crop_rect = crop_rect
+            self.source_pixbuf = imageops.crop_view(self.original_pixbuf, crop_rect)
+            if not self.crop_apply_id: # crop mode shows the whole image anyway
+                self.display_borders = crop_rect
+                self.update_display(force=True)
+        if state.bubbles and not self.bubble_da:
+            self.show_bubble_overlay()
+        elif not state.bubbles and self.bubble_da:
+            self.remove_bubble_overlay()
+        if state.bubbles:
+            # a new bubble is the one to edit; otherwise stick with the one
+            # that was being edited, if it's still there
+            if (self.bubble_selected is None or len(state.bubbles) != self.bubble_count
+                    or self.bubble_selected >= len(state.bubbles)):
+                self.bubble_selected = len(state.bubbles) - 1
+            self.bubble_count = len(state.bubbles)
+            self.select_bubble(self.bubble_selected)
+        self.update_undo_actions()
+
+    def update_undo_actions(self):
+        h = self.history
+        self.w.lookup_action("undo").set_enabled(bool(h and h.can_undo()))
+        self.w.lookup_action("redo").set_enabled(bool(h and h.can_redo()))
+        self.btnundo.set_tooltip_text("Undo %s" % (h.undo_name(),) if h and h.can_undo() else "Undo")
+        self.btnredo.set_tooltip_text("Redo %s" % (h.redo_name(),) if h and h.can_redo() else "Redo")
+
+    def undo(self, *args):
+        self.remove_crop_mode()
+        self.history.undo()
+        self.apply_edit_state()
+
+    def redo(self, *args):
+        self.remove_crop_mode()
+        self.history.redo()
+        self.apply_edit_state()
+
 def main():
-    m = Main()
+    if sys.argv[1:2] == ["--batch"]:
+        # no window, so none of Main; batch.py does it all
+        import batch
+        sys.exit(batch.main(sys.argv[2:]))
+    with tracing.startup.timed("create application"):
+        m = Main()
     m.app.run(sys.argv)
 
 if __name__ == "__main__": main()
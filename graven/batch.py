@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""Crops and captions lots of images at once, without a window.
+
+    graven --batch recipe.json photo1.jpg photo2.jpg ... --out DIR [--jobs N]
+
+The recipe says what to do to every image, in the same terms the editor
+uses: a crop in fractions of the whole image, like crop_borders, and bubbles
+with boxes in fractions of the cropped image.
+
+    {
+        "crop": [[0.1, 0.1], [0.9, 0.85]],
+        "bubbles": [
+            {"template": "speech", "box": [0.6, 0.3, 0.8, 0.5],
+             "text": "LOL", "font": "Impact"}
+        ],
+        "format": "jpeg"
+    }
+
+crop and bubbles can be left out; format is "png" (the default) or "jpeg".
+A template is the name of a bubble in the bubbles folder or your own bubble
+folder ("speech" for speech.bubble.svg), or a path to a bubble SVG.
+
+The images are shared out over a pool of processes, one per CPU unless
+--jobs says otherwise. Each one reads the bubble templates once, and keeps
+them (and its text fitting cache) for all the images it's given, so the
+later images don't pay for any of that.
+"""
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, GLib
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import export
+import history
+import imageops
+import svg2cairo
+import tracing
+
+BUBBLE_FOLDERS = [
+    os.path.join(os.path.split(__file__)[0], "..", "bubbles"),
+    os.path.join(GLib.get_user_data_dir(), "graven", "bubbles")
+]
+EXTENSIONS = {"png": ".png", "jpeg": ".jpg"}
+
+def find_template(template):
+    if os.path.exists(template): return template
+    for folder in BUBBLE_FOLDERS:
+        path = os.path.join(folder, template + ".bubble.svg")
+        if os.path.exists(path): return path
+    raise Exception("There's no bubble called '%s'" % (template,))
+
+def load_recipe(filename):
+    """Reads a recipe, and checks it, so that a mistake in it is found
+       before any images are done rather than once for every image."""
+    with open(filename) as fp:
+        recipe = json.load(fp)
+    recipe.setdefault("crop", imageops.FULL_IMAGE)
+    recipe.setdefault("bubbles", [])
+    recipe.setdefault("format", "png")
+    if recipe["format"] not in EXTENSIONS:
+        raise Exception("The recipe's format has to be png or jpeg, not '%s'" % (recipe["format"],))
+    recipe["crop"] = imageops.clamp_borders(recipe["crop"])
+    for bubble in recipe["bubbles"]:
+        bubble["template"] = find_template(bubble["template"])
+        if len(bubble.get("box", ())) != 4:
+            raise Exception("Each bubble needs a box: [left, top, right, bottom]")
+        bubble.setdefault("text", "")
+        bubble.setdefault("font", "Impact")
+    return recipe
+
+##################################################################
+# In the worker processes
+##################################################################
+
+# the edit state every image in this worker gets, made once by start_worker
+worker_state = None
+
+def start_worker(recipe):
+    global worker_state
+    templates = {}
+    for bubble in recipe["bubbles"]:
+        if bubble["template"] not in templates:
+            s2c = svg2cairo.SVG2Cairo()
+            with open(bubble["template"], "rb") as fp:
+                s2c.set_svg_as_string_sync(fp.read())
+            s2c.convert()
+            templates[bubble["template"]] = s2c
+    bubbles = tuple(history.Bubble(templates[b["template"]], tuple(b["box"]), b["text"], b["font"])
+        for b in recipe["bubbles"])
+    worker_state = history.initial_state()._replace(
+        crop_rect=tuple(tuple(corner) for corner in recipe["crop"]), bubbles=bubbles)
+
+def process_image(path, out_filename):
+    """Does one image; returns (seconds, megapixels) or raises."""
+    start = time.perf_counter()
+    try:
+        pb = GdkPixbuf.Pixbuf.new_from_file(path)
+    except GLib.Error as e:
+        # a plain exception, because it has to get back to the main process
+        raise Exception(e.message)
+    pb = pb.apply_embedded_orientation() or pb
+    job = export.Export(pb, worker_state, out_filename)
+    job.export()
+    return time.perf_counter() - start, pb.get_width() * pb.get_height() / 1e6
+
+##################################################################
+# In charge
+##################################################################
+
+def output_filenames(paths, out_dir, image_format):
+    """Where each image gets saved: its own name, in out_dir. Images from
+       different folders can have the same name (and a.png and a.jpg both
+       come out as a.png), so after the first one with a name, the rest get
+       a number on the end (a-2, a-3...) rather than overwriting it."""
+    extension = EXTENSIONS[image_format]
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    taken = set(names)
+    used = set()
+    filenames = []
+    for name in names:
+        unique = name
+        number = 1
+        # the first free name, skipping any another image is called
+        while unique in used or (unique != name and unique in taken):
+            number += 1
+            unique = "%s-%s" % (name, number)
+        used.add(unique)
+        filenames.append(os.path.join(out_dir, unique + extension))
+    return filenames
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="graven --batch",
+        description="Crop and caption lots of images, following a recipe")
+    parser.add_argument("recipe", help="recipe JSON file")
+    parser.add_argument("inputs", nargs="+", help="images to do")
+    parser.add_argument("--out", required=True, help="folder to save the results in")
+    parser.add_argument("--jobs", type=int, default=None, help="processes to use (default: one per CPU)")
+    args = parser.parse_args(argv)
+    tracing.setup(None)
+
+    try:
+        recipe = load_recipe(args.recipe)
+    except Exception as e:
+        print("Couldn't use recipe %s: %s" % (args.recipe, e), file=sys.stderr)
+        return 2
+    os.makedirs(args.out, exist_ok=True)
+
+    failures = 0
+    megapixels = 0
+    started = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+            initializer=start_worker, initargs=(recipe,)) as pool:
+        futures = {}
+        for path, out_filename in zip(args.inputs, output_filenames(args.inputs, args.out, recipe["format"])):
+            futures[pool.submit(process_image, path, out_filename)] = (path, out_filename)
+        for future in concurrent.futures.as_completed(futures):
+            path, out_filename = futures[future]
+            try:
+                seconds, image_megapixels = future.result()
+            except Exception as e:
+                failures += 1
+                print("%s: failed: %s" % (path, e), file=sys.stderr)
+                continue
+            megapixels += image_megapixels
+            print("%s -> %s  %.2fs  %.1fMP" % (path, out_filename, seconds, image_megapixels))
+
+    elapsed = time.perf_counter() - started
+    done = len(args.inputs) - failures
+    print("%s images in %.1fs (%s failed): %.0f images an hour, %.1f megapixels a second" % (
+        done, elapsed, failures, done / elapsed * 3600 if elapsed else 0,
+        megapixels / elapsed if elapsed else 0))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
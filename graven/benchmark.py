@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+"""Micro-benchmarks for svg2cairo and the image pipeline.
+
+Run with python3 benchmark.py. Nothing here needs a display, so it works on
+a headless machine. Each benchmark is run a number of times and the median
+and percentiles are printed; --json saves the results, and --compare shows
+how a run compares to some saved results.
+
+    python3 benchmark.py --json before.json
+    (change things)
+    python3 benchmark.py --compare before.json
+"""
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+gi.require_version('Pango', '1.0')
+gi.require_version('PangoCairo', '1.0')
+from gi.repository import GdkPixbuf, Pango, PangoCairo
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from xml.etree import ElementTree
+import cairo
+import svg2cairo
+import imageops
+import export
+import history
+
+BUBBLE_FOLDER = os.path.join(os.path.split(__file__)[0], "..", "bubbles")
+CROP = [[0.1, 0.15], [0.85, 0.9]]
+
+def percentile(ordered, fraction):
+    """Linearly interpolated percentile of an already sorted list."""
+    if len(ordered) == 1: return ordered[0]
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def summarise(times):
+    ordered = sorted(times)
+    return {
+        "runs": len(ordered),
+        "min": ordered[0],
+        "median": percentile(ordered, 0.5),
+        "p90": percentile(ordered, 0.9),
+        "p99": percentile(ordered, 0.99),
+        "max": ordered[-1],
+        "mean": sum(ordered) / len(ordered)
+    }
+
+def run(name, fn, repeat, setup=None, warmup=2):
+    """Times fn() repeat times, after a couple of untimed warmup calls. If
+       there's a setup function it's called (untimed) before each call, and
+       whatever it returns is passed to fn."""
+    times = []
+    extra = {}
+    for i in range(warmup + repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        result = fn(arg) if setup else fn()
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            times.append(elapsed)
+            if isinstance(result, dict): extra = result
+    stats = summarise(times)
+    stats.update(extra)
+    return name, stats
+
+##################################################################
+# Test data
+##################################################################
+
+def synthetic_svg(nodes, seed=1):
+    """An SVG with about this many drawing elements, in nested transformed
+       groups, and with the sort of Inkscape cruft that real bubbles have."""
+    rnd = random.Random(seed)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+        '<svg xmlns="http://www.w3.org/2000/svg" '
+        'xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd" '
+        'xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" viewBox="0 0 1000 1000">',
+        '<sodipodi:namedview id="namedview" pagecolor="#ffffff" inkscape:zoom="1" />',
+        '<metadata>%s</metadata>' % ("<item>cruft</item>" * 50),
+        '<rect id="textbox" x="200" y="200" width="600" height="400" style="fill:#ffffff" />']
+    style = "fill:#ffffff;stroke:#000000;stroke-width:%s"
+    for i in range(nodes):
+        if i % 50 == 0:
+            if i: parts.append("</g>")
+            parts.append('<g transform="translate(%s,%s) rotate(%s)">' % (
+                rnd.randint(0, 50), rnd.randint(0, 50), rnd.randint(0, 10)))
+        kind = i % 3
+        if kind == 0:
+            d = "M %s,%s " % (rnd.random() * 1000, rnd.random() * 1000)
+            d += " ".join("C %.2f,%.2f %.2f,%.2f %.2f,%.2f" % tuple(rnd.random() * 1000 for j in range(6))
+                for k in range(5))
+            parts.append('<path style="%s" d="%s z" />' % (style % rnd.randint(1, 5), d))
+        elif kind == 1:
+            parts.append('<rect style="%s" x="%s" y="%s" width="%s" height="%s" />' % (
+                style % 2, rnd.randint(0, 900), rnd.randint(0, 900), rnd.randint(5, 100), rnd.randint(5, 100)))
+        else:
+            parts.append('<ellipse style="%s" cx="%s" cy="%s" rx="%s" ry="%s" />' % (
+                style % 3, rnd.randint(0, 1000), rnd.randint(0, 1000), rnd.randint(5, 50), rnd.randint(5, 50)))
+    parts.append("</g></svg>")
+    return "\n".join(parts).encode("utf-8")
+
+def bubble_files():
+    return sorted(glob.glob(os.path.join(BUBBLE_FOLDER, "*.bubble.svg")))
+
+def read_file(path):
+    with open(path, "rb") as fp:
+        return fp.read()
+
+def converter(svg_string, **kwargs):
+    s2c = svg2cairo.SVG2Cairo(**kwargs)
+    s2c.set_svg_as_string_sync(svg_string)
+    return s2c
+
+def test_pixbuf(width, height):
+    pb = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, width, height)
+    pb.fill(0x336699ff)
+    return pb
+
+FIT_TEXTS = {
+    "short": "LOL",
+    "long": "This is a journey into sound. Stereophonic sound. " * 4,
+    "multiline": "The mask.\nThe ray-traced picture.\nAnd finally,\nthe wireframe city.\n" * 2
+}
+# the last two are the shipped bubbles' textboxes, which aren't whole pixels
+FIT_BOXES = [(200, 100), (800, 600), (3000, 2000), (794.28577, 437.14285), (682.85724, 397.14288)]
+PATH_SEGMENTS = [10000, 50000]
+RENDER_SIZES = [100, 400, 1600]
+CROP_SIZES = {"12MP": (4000, 3000), "50MP": (8160, 6120)}
+EXPORT_SIZES = {"12MP": (4000, 3000), "50MP": (8160, 6120), "100MP": (20000, 5000)}
+
+##################################################################
+# Benchmarks
+##################################################################
+
+def bench_convert(repeat, quick):
+    results = []
+    svgs = [(os.path.basename(f).split(".")[0], read_file(f)) for f in bubble_files()]
+    for nodes in ([1000] if quick else [1000, 5000]):
+        svgs.append(("synthetic-%s" % nodes, synthetic_svg(nodes)))
+    for name, svg_string in svgs:
+        def convert():
+            result = converter(svg_string).convert()
+            return {"instructions": len(result["instructions"])}
+        results.append(run("convert/%s" % name, convert, repeat if len(svg_string) < 100000 else max(repeat // 5, 3)))
+    return results
+
+def benchmark_font():
+    families = svg2cairo.font_families()
+    for font in ("Sans", "sans-serif", "DejaVu Sans"):
+        if font in families: return font
+    return sorted(families)[0]
+
+def set_hinting(layout, hinted):
+    """Turns hinting (and whole-pixel glyph metrics) on or off for layout."""
+    options = cairo.FontOptions()
+    options.set_hint_metrics(cairo.HINT_METRICS_ON if hinted else cairo.HINT_METRICS_OFF)
+    options.set_hint_style(cairo.HINT_STYLE_DEFAULT if hinted else cairo.HINT_STYLE_NONE)
+    PangoCairo.context_set_font_options(layout.get_context(), options)
+    layout.context_changed()
+
+def binary_search_font_size(layout, font, w, h):
+    """The font size fit_text used to find, for layout's text in a w x h
+       box: the original search, doubling from 100 until the text was too
+       big and then binary searching, as it was. Returns the size along with
+       how many sizes it measured, so the solver can be checked against it.
+       (The original left the layout at whichever size it measured last,
+       which could be one too big; the size it had found is first - 1.)"""
+    fd = Pango.FontDescription.new()
+    fd.set_family(font)
+    probes = 0
+    size = 100
+    while 1:
+        probes += 1
+        fd.set_absolute_size(size)
+        layout.set_font_description(fd)
+        s = layout.get_pixel_size()
+        if s.width > w or s.height > h:
+            break
+        size = size * 2
+    first = 0
+    last = size
+    while first <= last:
+        probes += 1
+        midpoint = ((first + last) // 2)
+        fd.set_absolute_size(midpoint)
+        layout.set_font_description(fd)
+        s = layout.get_pixel_size()
+        if s.width < w and s.height < h:
+            first = midpoint + 1
+        else:
+            last = midpoint - 1
+    return max(first - 1, 1), probes
+
+def bench_fit_text(repeat, quick):
+    """Fitting text from cold, with hinting off and on, along with the size
+       the old binary search picked for the same text and box; size and
+       old_size should always be the same."""
+    results = []
+    font = benchmark_font()
+    layout = svg2cairo.new_text_layout()
+    for hinted in (False, True):
+        set_hinting(layout, hinted)
+        hinting = "hinted" if hinted else "unhinted"
+        for text_name, text in FIT_TEXTS.items():
+            for w, h in FIT_BOXES:
+                layout.set_text(text, -1)
+                old_size, old_probes = binary_search_font_size(layout, font, w, h)
+                def cold():
+                    # an empty cache, so this is the full font size search
+                    svg2cairo.fit_cache.clear()
+                    ly = svg2cairo.fit_text(text, font, w, h, layout)
+                    return {"probes": svg2cairo.fit_cache.probes, "old_probes": old_probes,
+                        "size": ly.get_font_description().get_size(), "old_size": old_size}
+                results.append(run("fit_text/%s/%s/%gx%g/cold" % (hinting, text_name, w, h), cold, repeat))
+            def warm():
+                svg2cairo.fit_text(text, font, 800, 600, layout)
+                return {"probes": svg2cairo.fit_cache.probes}
+            svg2cairo.fit_cache.clear()
+            results.append(run("fit_text/%s/%s/800x600/cached" % (hinting, text_name), warm, repeat))
+    return results
+
+def old_path_data(segments, seed=1):
+    """Path data with this many segments which the old splitter can read:
+       M, L and l with comma separated points, and a Z now and then."""
+    rnd = random.Random(seed)
+    parts = ["M %.3f,%.3f" % (rnd.random() * 1000, rnd.random() * 1000)]
+    for i in range(1, segments):
+        if i % 100 == 0:
+            parts.append("Z M %.3f,%.3f" % (rnd.random() * 1000, rnd.random() * 1000))
+        elif i % 2:
+            parts.append("L %.3f,%.3f" % (rnd.random() * 1000, rnd.random() * 1000))
+        else:
+            parts.append("l %.3f,%.3f" % (rnd.random() * 20 - 10, rnd.random() * 20 - 10))
+    return " ".join(parts) + " Z"
+
+def curve_path_data(segments, seed=1):
+    """Path data with this many segments using the rest of the grammar:
+       curves, arcs and numbers run together, which only the new parser reads."""
+    rnd = random.Random(seed)
+    def n():
+        return "%.2f" % (rnd.random() * 1000 - 500,)
+    kinds = [
+        lambda: "C%s,%s %s,%s %s,%s" % tuple(n() for i in range(6)),
+        lambda: "s%s%s%s%s" % tuple(("" if v.startswith("-") else " ") + v for v in (n(), n(), n(), n())),
+        lambda: "Q%s %s %s %s" % (n(), n(), n(), n()),
+        lambda: "a%d %d 0 %d%d%s,%s" % (rnd.randint(1, 50), rnd.randint(1, 50),
+            rnd.randint(0, 1), rnd.randint(0, 1), n(), n()),
+        lambda: "h%sv%s" % (n(), n())
+    ]
+    return "M0,0 " + " ".join(kinds[i % len(kinds)]() for i in range(segments - 1))
+
+def split_path(s2c, node):
+    """parse_path as it was: split on whitespace, and understand only M, m,
+       L, l and Z with comma separated points."""
+    if not s2c.expect(node, ["d"]): return
+    d = node.get("d").split()
+    instructions = []
+    mode = None
+    for item in d:
+        if item == "M":
+            mode = "move_to"
+        elif item == "m":
+            mode = "rel_move_to"
+        elif item == "l":
+            mode = "rel_line_to"
+        elif item == "L":
+            mode = "line_to"
+        elif item == "Z" or item == "z":
+            instructions.append(["close_path", []])
+        elif mode == "move_to":
+            parts = [float(x) for x in item.split(",")]
+            instructions.append(["move_to", parts])
+            mode = "line_to"
+        elif mode == "rel_line_to":
+            parts = [float(x) for x in item.split(",")]
+            instructions.append(["rel_line_to", parts])
+        elif mode == "line_to":
+            parts = [float(x) for x in item.split(",")]
+            instructions.append(["line_to", parts])
+        else:
+            return
+    return instructions
+
+def bench_path_parse(repeat, quick):
+    """Parsing long path data, with the old splitter and with parse_path.
+       The old splitter only gets the paths it can read."""
+    results = []
+    s2c = svg2cairo.SVG2Cairo()
+    for segments in PATH_SEGMENTS[:1] if quick else PATH_SEGMENTS:
+        paths = [("lines", old_path_data(segments)), ("curves", curve_path_data(segments))]
+        for kind, d in paths:
+            node = ElementTree.Element("path", d=d)
+            parsers = [("new", s2c.parse_path)]
+            if kind == "lines": parsers.insert(0, ("old", lambda node: split_path(s2c, node)))
+            for parser_name, parse in parsers:
+                def parse_once():
+                    return {"instructions": len(parse(node))}
+                results.append(run("path_parse/%s/%s/%s" % (kind, segments, parser_name),
+                    parse_once, max(repeat // 5, 3)))
+    return results
+
+def bench_render(repeat, quick):
+    results = []
+    font = benchmark_font()
+    text = "This is a journey\ninto sound.\nStereophonic sound."
+    for path in bubble_files():
+        bubble = os.path.basename(path).split(".")[0]
+        for compiled in (False, True):
+            s2c = converter(read_file(path), compiled=compiled)
+            for size in RENDER_SIZES:
+                surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+                def render():
+                    ctx = cairo.Context(surface)
+                    s2c.render_to_context_at_size_with_text(ctx, 0, 0, size, size, text, font)
+                    surface.flush()
+                results.append(run("render/%s/%s/%s" % (bubble, "compiled" if compiled else "interpreted", size),
+                    render, repeat))
+    return results
+
+def bench_crop(repeat, quick):
+    results = []
+    for name, (w, h) in CROP_SIZES.items():
+        if quick and name != "12MP": continue
+        pb = test_pixbuf(w, h)
+        results.append(run("crop/%s" % (name,), lambda pb=pb: imageops.crop_pixbuf(pb, CROP), max(repeat // 5, 3)))
+        results.append(run("crop/%s/view" % (name,), lambda pb=pb: imageops.crop_view(pb, CROP), repeat))
+        del pb
+    return results
+
+def export_in_child(width, height, tiled, results):
+    """Runs in a process of its own, so that its peak memory use is just
+       this export's: how much more than the source image it needed."""
+    pb = test_pixbuf(width, height)
+    bubbles = tuple(history.Bubble(converter(read_file(path)), (0.1 + i * 0.2, 0.1, 0.3 + i * 0.2, 0.6), "LOL")
+        for i, path in enumerate(bubble_files()[:3]))
+    state = history.initial_state()._replace(bubbles=bubbles)
+    fd, filename = tempfile.mkstemp(suffix=".png")
+    os.close(fd)
+    try:
+        job = export.Export(pb, state, filename, tiled=tiled)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        if tiled:
+            job.flatten_tiled()
+        else:
+            job.flatten()
+        elapsed = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        os.unlink(filename)
+    results.put((elapsed, (after - before) // 1024))
+
+def bench_export(repeat, quick):
+    """Exporting to PNG, whole and in strips. These are slow, and each one
+       is a fresh process, so they're only run a few times; peak_mb is the
+       most memory any run needed on top of the image itself."""
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for name, (w, h) in EXPORT_SIZES.items():
+        if quick and name != "12MP": continue
+        for tiled in (False, True):
+            times = []
+            peak = 0
+            for i in range(min(repeat, 3)):
+                queue = context.Queue()
+                process = context.Process(target=export_in_child, args=(w, h, tiled, queue))
+                process.start()
+                elapsed, peak_mb = queue.get()
+                process.join()
+                times.append(elapsed)
+                peak = max(peak, peak_mb)
+            stats = summarise(times)
+            stats["peak_mb"] = peak
+            results.append(("export/%s/%s" % (name, "tiled" if tiled else "whole"), stats))
+    return results
+
+BENCHMARKS = [
+    ("convert", bench_convert),
+    ("path_parse", bench_path_parse),
+    ("fit_text", bench_fit_text),
+    ("render", bench_render),
+    ("crop", bench_crop),
+    ("export", bench_export)
+]
+
+##################################################################
+# Reporting
+##################################################################
+
+def format_time(seconds):
+    if seconds < 1e-3: return "%.1fus" % (seconds * 1e6)
+    if seconds < 1: return "%.2fms" % (seconds * 1e3)
+    return "%.2fs" % (seconds,)
+
+def report(results, baseline=None):
+    width = max(len(name) for name in results)
+    for name, stats in results.items():
+        line = "%s  median %9s  p90 %9s  p99 %9s  min %9s" % (name.ljust(width),
+            format_time(stats["median"]), format_time(stats["p90"]),
+            format_time(stats["p99"]), format_time(stats["min"]))
+        extras = ["%s %s" % (k, stats[k]) for k in ("instructions", "probes", "old_probes", "size", "old_size", "peak_mb") if k in stats]
+        if extras: line += "  " + ", ".join(extras)
+        if baseline and name in baseline:
+            ratio = stats["median"] / baseline[name]["median"]
+            line += "  %.2fx %s" % (ratio if ratio >= 1 else 1 / ratio, "slower" if ratio >= 1 else "faster")
+        print(line)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark svg2cairo and the image pipeline")
+    parser.add_argument("--repeat", type=int, default=50, help="timed runs per benchmark")
+    parser.add_argument("--quick", action="store_true", help="fewer, smaller cases")
+    parser.add_argument("--only", action="append", choices=[name for name, fn in BENCHMARKS],
+        help="only run these groups of benchmarks")
+    parser.add_argument("--json", help="save results to this file")
+    parser.add_argument("--compare", help="compare against results saved with --json")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, fn in BENCHMARKS:
+        if args.only and name not in args.only: continue
+        for result_name, stats in fn(args.repeat, args.quick):
+            results[result_name] = stats
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)["results"]
+    report(results, baseline)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump({
+                "meta": {
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cairo": cairo.cairo_version_string(),
+                    "pango": Pango.version_string()
+                },
+                "results": results
+            }, fp, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""All the bubbles graven knows about, kept up to date while it runs.
+
+The index is the bubble pack (bubblepack.py): for each bubble it has the
+path, mtime, size and content hash, and the compiled instructions. The
+bubble folders are watched with Gio.FileMonitor, and when a bubble is added,
+edited or deleted only that bubble is looked at again; then whoever's
+listening (the bubble menu) is told, and the pack is written back out.
+"""
+
+from gi.repository import Gio, GLib
+from collections import OrderedDict
+import glob
+import os
+import bubblepack
+from tracing import log
+
+BUBBLE_SUFFIX = ".bubble.svg"
+
+class BubbleLibrary(object):
+    # editors tend to write a file in several goes, so wait for things to go
+    # quiet for this long before looking at a changed bubble
+    SETTLE_MS = 300
+    INTERESTING_EVENTS = (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED,
+        Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.MOVED_IN,
+        Gio.FileMonitorEvent.MOVED_OUT, Gio.FileMonitorEvent.RENAMED)
+
+    def __init__(self, folders, pack_file):
+        # absolute and normalised, so they match the paths GIO hands us
+        self.folders = [os.path.abspath(f) for f in folders]
+        self.pack_file = pack_file
+        # path -> pack entry, or None for a bubble which couldn't be packed
+        self.bubbles = OrderedDict()
+        self.monitors = []
+        self.listeners = []
+        self.dirty = set()
+        self.settle_timeout = None
+
+    def scan(self):
+        """Finds every bubble, and loads (or rebuilds) the pack for them."""
+        paths = []
+        for f in self.folders:
+            if os.path.isdir(f):
+                paths += glob.glob(os.path.join(f, "*" + BUBBLE_SUFFIX))
+        pack = bubblepack.load_or_rebuild(self.pack_file, paths)
+        self.bubbles = OrderedDict((path, pack.entry_for(path)) for path in paths)
+
+    def add_listener(self, fn):
+        """fn(event, path, entry) is called whenever a bubble changes, where
+           event is "added", "changed" or "removed"."""
+        self.listeners.append(fn)
+
+    def notify(self, event, path, entry):
+        for fn in self.listeners:
+            fn(event, path, entry)
+
+    def start_monitoring(self):
+        for folder in self.folders:
+            # watching a folder which doesn't exist yet is fine; GIO will
+            # tell us about it if it turns up
+            monitor = Gio.File.new_for_path(folder).monitor_directory(
+                Gio.FileMonitorFlags.WATCH_MOVES, None)
+            monitor.connect("changed", self.folder_changed)
+            self.monitors.append(monitor)
+
+    def stop_monitoring(self):
+        for monitor in self.monitors:
+            monitor.cancel()
+        self.monitors = []
+
+    def folder_changed(self, monitor, f, other_file, event):
+        if event not in self.INTERESTING_EVENTS: return
+        for changed in (f, other_file):
+            # a rename is both the old name going and the new one arriving
+            path = changed.get_path() if changed else None
+            if path and path.endswith(BUBBLE_SUFFIX):
+                self.dirty.add(path)
+        if self.dirty:
+            if self.settle_timeout:
+                GLib.source_remove(self.settle_timeout)
+            self.settle_timeout = GLib.timeout_add(self.SETTLE_MS, self.refresh)
+
+    def refresh(self):
+        self.settle_timeout = None
+        dirty = sorted(self.dirty)
+        self.dirty = set()
+        changed = False
+        for path in dirty:
+            known = path in self.bubbles
+            if not os.path.exists(path):
+                if known:
+                    del self.bubbles[path]
+                    log.debug("Bubble removed: %s", path)
+                    self.notify("removed", path, None)
+                    changed = True
+                continue
+            old = self.bubbles.get(path)
+            entry = bubblepack.refresh_entry(path, old)
+            if known and entry is old: continue
+            self.bubbles[path] = entry
+            changed = True
+            if known and old and entry and old.sha1 == entry.sha1:
+                continue # touched, not edited; nobody else needs to know
+            log.debug("Bubble %s: %s", "changed" if known else "added", path)
+            self.notify("changed" if known else "added", path, entry)
+        if changed:
+            bubblepack.write_pack(self.pack_file, [e for e in self.bubbles.values() if e])
+        return False
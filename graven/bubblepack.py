@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""A compiled "bubble pack": every bubble's converted instructions and sizes
+in one binary file, so that startup doesn't have to re-read and
+re-parse every bubble SVG each time.
+
+The file is mmapped and the instruction arrays are read straight out of the
+map through memoryviews, without copying. A pack is only rebuilt when one of
+its source SVGs has changed (by mtime and size, and then by content hash), and
+then only the changed bubbles are reparsed.
+
+Layout, all little-endian apart from the float arrays, which are native
+(the header records which order that is, and a pack from a machine with the
+other order is just rebuilt):
+
+    header:  magic "GRVNPACK", u16 pack version, u16 converter version,
+             u8 byte order (0 little, 1 big), 3 bytes padding,
+             u32 entry count, u64 index offset
+    data:    per bubble, a u8 opcode array, padding to 8 bytes, and an f64
+             array of all the instructions' parameters
+    index:   per bubble, u16 path length, path (utf-8), i64 mtime_ns,
+             u64 size, 20 byte sha1, f64 width, f64 height, u8 has textbox,
+             4 x f64 textbox, u64 ops offset, u32 ops count,
+             u64 floats offset, u32 floats count
+
+Menu thumbnails aren't in here; they're in the thumbnail cache (thumbnails.py).
+"""
+
+import array
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import cairo
+import svg2cairo
+from tracing import log
+
+MAGIC = b"GRVNPACK"
+PACK_VERSION = 2
+HEADER = struct.Struct("<8sHHB3xIQ")
+INDEX_ENTRY = struct.Struct("<qQ20sddB4dQIQI")
+
+# cairo context methods and how many float parameters each takes; the opcode
+# for an instruction is its position in this list. Never reorder it without
+# bumping PACK_VERSION.
+OPCODES = [
+    ("move_to", 2), ("line_to", 2), ("rel_move_to", 2), ("rel_line_to", 2),
+    ("curve_to", 6), ("rel_curve_to", 6), ("close_path", 0), ("new_path", 0),
+    ("rectangle", 4), ("arc", 5), ("save", 0), ("restore", 0),
+    ("translate", 2), ("scale", 2), ("multiply_by_matrix", 6),
+    ("set_line_width", 1), ("set_source_rgba", 4),
+    ("stroke", 0), ("stroke_preserve", 0), ("fill", 0), ("fill_preserve", 0),
+    ("transform", 6)
+]
+MATRIX_OPS = ("multiply_by_matrix", "transform")
+OPCODE_NUMBERS = dict((name, i) for i, (name, nargs) in enumerate(OPCODES))
+BYTE_ORDER = 0 if sys.byteorder == "little" else 1
+
+
+def encode_instructions(instructions):
+    """Turns a converted instruction list into an opcode array and a float array."""
+    ops = array.array("B")
+    floats = array.array("d")
+    for cmd, params in instructions:
+        opcode = OPCODE_NUMBERS.get(cmd)
+        if opcode is None:
+            raise Exception("Can't pack instruction '%s'" % (cmd,))
+        if cmd in MATRIX_OPS:
+            m = params[0]
+            params = [m.xx, m.yx, m.xy, m.yy, m.x0, m.y0]
+        if len(params) != OPCODES[opcode][1]:
+            raise Exception("Instruction '%s' has %s parameters, expected %s" % (
+                cmd, len(params), OPCODES[opcode][1]))
+        ops.append(opcode)
+        floats.extend(params)
+    return ops, floats
+
+
+def decode_instructions(ops, floats):
+    instructions = []
+    fi = 0
+    for opcode in ops:
+        cmd, nargs = OPCODES[opcode]
+        params = list(floats[fi:fi + nargs])
+        fi += nargs
+        if cmd in MATRIX_OPS:
+            params = [cairo.Matrix(*params)]
+        instructions.append([cmd, params])
+    return instructions
+
+
+class BubblePackEntry(object):
+    def __init__(self, path, mtime_ns, size, sha1, width, height, textbox, ops, floats):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.sha1 = sha1
+        self.width = width
+        self.height = height
+        self.textbox = textbox
+        # these are memoryviews into the pack's mmap when loaded from a file,
+        # or arrays/bytes for entries which have just been built
+        self.ops = ops
+        self.floats = floats
+
+    def converted_result(self):
+        """The same dict that SVG2Cairo.convert() would have made for this bubble."""
+        return {
+            "width": self.width, "height": self.height,
+            "instructions": decode_instructions(self.ops, self.floats),
+            "textbox": self.textbox, "rotator": None
+        }
+
+    @classmethod
+    def build(cls, path, st, contents, sha1):
+        """Parses one bubble SVG."""
+        s2c = svg2cairo.SVG2Cairo()
+        s2c.set_svg_as_string_sync(contents)
+        result = s2c.convert()
+        ops, floats = encode_instructions(result["instructions"])
+        return cls(path, st.st_mtime_ns, st.st_size, sha1, result["width"], result["height"],
+            result["textbox"], ops, floats)
+
+
+class BubblePack(object):
+    def __init__(self, entries=None):
+        self.entries = entries or []
+        # the library asks for every bubble by path, so don't make it look
+        # through all of them each time
+        self.by_path = dict((e.path, e) for e in self.entries)
+        self.mmap = None
+
+    def entry_for(self, path):
+        return self.by_path.get(path)
+
+    @classmethod
+    def load(cls, filename):
+        """Maps a pack file. Returns None if there's no usable pack there."""
+        try:
+            fp = open(filename, "rb")
+        except OSError:
+            return None
+        with fp:
+            try:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None # empty file
+        view = memoryview(mm)
+        try:
+            magic, version, converter_version, byte_order, count, index_offset = HEADER.unpack_from(view, 0)
+            if (magic != MAGIC or version != PACK_VERSION or byte_order != BYTE_ORDER or
+                    converter_version != svg2cairo.CONVERTER_VERSION):
+                return None
+            entries = []
+            pos = index_offset
+            for i in range(count):
+                (path_length,) = struct.unpack_from("<H", view, pos)
+                pos += 2
+                path = bytes(view[pos:pos + path_length]).decode("utf-8")
+                pos += path_length
+                (mtime_ns, size, sha1, width, height, has_textbox, tx, ty, tw, th,
+                    ops_offset, ops_count, floats_offset, floats_count) = INDEX_ENTRY.unpack_from(view, pos)
+                pos += INDEX_ENTRY.size
+                entries.append(BubblePackEntry(path, mtime_ns, size, sha1, width, height,
+                    [tx, ty, tw, th] if has_textbox else None,
+                    view[ops_offset:ops_offset + ops_count],
+                    view[floats_offset:floats_offset + floats_count * 8].cast("d")))
+        except (struct.error, UnicodeDecodeError, TypeError, ValueError):
+            # truncated or otherwise mangled; we'll just build a new one
+            return None
+        pack = cls(entries)
+        pack.mmap = mm
+        return pack
+
+    def write(self, filename):
+        data = bytearray(HEADER.size)
+        index = bytearray()
+        for e in self.entries:
+            ops_offset = len(data)
+            data += bytes(e.ops)
+            data += b"\0" * (-len(data) % 8)
+            floats_offset = len(data)
+            data += bytes(e.floats)
+            path = e.path.encode("utf-8")
+            textbox = e.textbox or [0, 0, 0, 0]
+            index += struct.pack("<H", len(path)) + path
+            index += INDEX_ENTRY.pack(e.mtime_ns, e.size, e.sha1, e.width, e.height,
+                1 if e.textbox else 0, *textbox,
+                ops_offset, len(e.ops), floats_offset, len(e.floats))
+        HEADER.pack_into(data, 0, MAGIC, PACK_VERSION, svg2cairo.CONVERTER_VERSION,
+            BYTE_ORDER, len(self.entries), len(data))
+        data += index
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp, filename)
+
+
+def refresh_entry(path, old=None):
+    """Returns an up to date entry for path: old itself if the file hasn't
+       changed, a copy of old if the file was touched but its contents are
+       the same, and otherwise a newly built one. Returns None if the file's
+       gone or can't be converted."""
+    try:
+        st = os.stat(path)
+        if old and old.mtime_ns == st.st_mtime_ns and old.size == st.st_size:
+            return old
+        with open(path, "rb") as fp:
+            contents = fp.read()
+    except OSError:
+        return None
+    sha1 = hashlib.sha1(contents).digest()
+    if old and old.sha1 == sha1:
+        # touched but not actually changed
+        return BubblePackEntry(path, st.st_mtime_ns, st.st_size, sha1, old.width,
+            old.height, old.textbox, old.ops, old.floats)
+    try:
+        return BubblePackEntry.build(path, st, contents, sha1)
+    except Exception as e:
+        log.warning("Couldn't pack bubble '%s': %s", path, e)
+        return None
+
+
+def write_pack(filename, entries):
+    """Makes a BubblePack of entries and saves it (if it can) to filename."""
+    pack = BubblePack(entries)
+    try:
+        pack.write(filename)
+    except OSError as e:
+        log.warning("Couldn't write bubble pack '%s': %s", filename, e)
+    return pack
+
+
+def load_or_rebuild(filename, bubble_files):
+    """Returns a BubblePack for bubble_files, loading it from filename if that's
+       up to date, and otherwise rebuilding whichever entries are stale and
+       writing the result back out. Bubbles which can't be converted are left
+       out of the pack."""
+    pack = BubblePack.load(filename)
+    old_entries = pack.by_path if pack else {}
+    entries = []
+    for path in bubble_files:
+        entry = refresh_entry(path, old_entries.get(path))
+        if entry: entries.append(entry)
+    if pack and len(entries) == len(pack.entries) and all(
+            new is old for new, old in zip(entries, pack.entries)):
+        return pack
+    return write_pack(filename, entries)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""Flattens the image and its bubbles into one full resolution picture.
+
+That's a lot of pixels for a big photo, so it's done in a worker thread:
+the image is painted onto a cairo.ImageSurface, each bubble is drawn on top
+at its real size, and then the lot is either saved as a PNG or JPEG or turned
+back into a pixbuf. Progress and the result come back on the main thread.
+
+A really big image (a 100 megapixel panorama, say) would need a 400MB
+surface, and then the same again to turn it into a pixbuf, so those are done
+in strips instead: each strip gets its slice of the image and whichever
+bubbles overlap it, and then goes straight into the PNG file before the next
+one is drawn. So saving a PNG never needs more than a strip or two of memory,
+however big the image is. GdkPixbuf can't write a JPEG a bit at a time, so
+for JPEGs (and for Apply, which wants a pixbuf back) the strips are put
+together into one pixbuf; that's still a lot less than doing it all at once.
+"""
+
+import gi
+gi.require_version('Gdk', '3.0')
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import Gdk, GdkPixbuf, GLib
+import os
+import struct
+import threading
+import time
+import zlib
+import cairo
+import imageops
+import tracing
+from tracing import log
+
+JPEG_QUALITY = 92
+# images with more pixels than this are exported in strips
+TILED_PIXELS = 24 * 1000 * 1000
+STRIP_HEIGHT = 256
+
+class Cancelled(Exception): pass
+
+def format_for(filename):
+    """"png" or "jpeg", from filename's extension."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".png": return "png"
+    if ext in (".jpg", ".jpeg"): return "jpeg"
+    raise Exception("Don't know how to save '%s'; use a .png or .jpg filename" % (filename,))
+
+def bubble_area(box, width, height):
+    """A bubble's box, which is in fractions of the (cropped) image, as
+       x, y, width, height in that image's pixels."""
+    return (box[0] * width, box[1] * height, (box[2] - box[0]) * width, (box[3] - box[1]) * height)
+
+def strip_overlaps(area, top, bottom, margin):
+    """Whether a bubble drawn at area touches the rows from top to bottom.
+       Bubble outlines poke out of their box by up to margin pixels, however
+       big or small the bubble is drawn."""
+    x, y, w, h = area
+    return y - margin < bottom and y + h + margin > top
+
+class PNGWriter(object):
+    """Writes a PNG a few rows at a time, so the whole image never has to be
+       in memory at once. Rows come from pixbufs, which are RGB or RGBA with
+       no premultiplying, which is just what PNG wants."""
+    def __init__(self, filename, width, height, alpha):
+        self.filename = filename
+        self.width = width
+        self.channels = 4 if alpha else 3
+        self.compressor = zlib.compressobj()
+        self.fp = open(filename, "wb")
+        self.fp.write(b"\x89PNG\r\n\x1a\n")
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6 if alpha else 2, 0, 0, 0))
+
+    def chunk(self, kind, data):
+        self.fp.write(struct.pack(">I", len(data)) + kind + data +
+            struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    def write_pixbuf(self, pb):
+        pixels = pb.get_pixels()
+        rowstride = pb.get_rowstride()
+        row_bytes = self.width * self.channels
+        # each row starts with its filter type; 0 is none
+        rows = b"".join(b"\x00" + pixels[i * rowstride:i * rowstride + row_bytes]
+            for i in range(pb.get_height()))
+        compressed = self.compressor.compress(rows)
+        if compressed: self.chunk(b"IDAT", compressed)
+
+    def close(self):
+        self.chunk(b"IDAT", self.compressor.flush())
+        self.chunk(b"IEND", b"")
+        self.fp.close()
+
+    def abort(self):
+        self.fp.close()
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+class Export(object):
+    def __init__(self, original, state, filename=None, progress=None, finished=None, failed=None,
+            tiled=None):
+        """Exports state (a history.EditState) applied to the original pixbuf.
+           If there's a filename it's saved there and finished(filename) is
+           called; otherwise finished(pixbuf) gets the flattened image.
+           progress(fraction) is called along the way, and failed(message)
+           if it goes wrong. All the callbacks happen on the main thread.
+           tiled says whether to do it in strips; by default, only if the
+           image is big enough to need it."""
+        self.view = imageops.crop_view(original, state.crop_rect)
+        # each bubble gets a copy of its own, because the originals are
+        # being drawn on the main thread at the same time
+        self.bubbles = [(bubble.s2c.clone(), bubble.box, bubble.text, bubble.font)
+            for bubble in state.bubbles]
+        self.filename = filename
+        self.format = format_for(filename) if filename else None
+        self.progress = progress
+        self.finished = finished
+        self.failed = failed
+        self.cancelled = threading.Event()
+        self.thread = None
+        if tiled is None:
+            tiled = self.view.get_width() * self.view.get_height() > TILED_PIXELS
+        self.tiled = tiled
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def report(self, fn, *args):
+        """Calls fn(*args) on the main thread, unless we've been cancelled."""
+        def call():
+            if not self.cancelled.is_set(): fn(*args)
+            return False
+        if fn: GLib.idle_add(call)
+
+    def check(self, fraction):
+        if self.cancelled.is_set(): raise Cancelled()
+        self.report(self.progress, fraction)
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            result = self.export()
+        except Cancelled:
+            log.debug("Export cancelled")
+            return
+        except Exception as e:
+            log.exception("Export failed")
+            self.report(self.failed, str(e))
+            return
+        if tracing.tracer.filename:
+            tracing.tracer.add("export", started, time.perf_counter(),
+                {"width": self.view.get_width(), "height": self.view.get_height(),
+                 "bubbles": len(self.bubbles), "format": self.format, "tiled": self.tiled})
+        self.report(self.finished, result)
+
+    def export(self):
+        """Does the export, there and then, and returns the result."""
+        return self.flatten_tiled() if self.tiled else self.flatten()
+
+    def flatten(self):
+        w = self.view.get_width()
+        h = self.view.get_height()
+        # a bubble's box can hang off the edge of the image, but only the
+        # image is exported; and only keep alpha if there was some to start with
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32 if self.view.get_has_alpha()
+            else cairo.FORMAT_RGB24, w, h)
+        context = cairo.Context(surface)
+        # (this doesn't go anywhere near the display, so it's fine off the main thread)
+        Gdk.cairo_set_source_pixbuf(context, self.view, 0, 0)
+        context.paint()
+        steps = len(self.bubbles) + 2
+        self.check(1 / steps)
+
+        for i, (s2c, box, text, font) in enumerate(self.bubbles):
+            x, y, bw, bh = bubble_area(box, w, h)
+            s2c.render_to_context_at_size_with_text(context, x, y, bw, bh, text, font)
+            self.check((i + 2) / steps)
+        surface.flush()
+
+        if self.format == "png":
+            surface.write_to_png(self.filename)
+            return self.filename
+        pb = Gdk.pixbuf_get_from_surface(surface, 0, 0, w, h)
+        del surface
+        if self.format == "jpeg":
+            pb.savev(self.filename, "jpeg", ["quality"], [str(JPEG_QUALITY)])
+            return self.filename
+        return pb
+
+    def flatten_tiled(self):
+        w = self.view.get_width()
+        h = self.view.get_height()
+        alpha = self.view.get_has_alpha()
+        surface_format = cairo.FORMAT_ARGB32 if alpha else cairo.FORMAT_RGB24
+        areas = [bubble_area(box, w, h) for s2c, box, text, font in self.bubbles]
+        margins = [s2c.outline_margin() for s2c, box, text, font in self.bubbles]
+        if self.format == "png":
+            writer = PNGWriter(self.filename, w, h, alpha)
+            whole = None
+        else:
+            writer = None
+            whole = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, alpha, 8, w, h)
+
+        tops = range(0, h, STRIP_HEIGHT)
+        try:
+            for i, top in enumerate(tops):
+                strip_height = min(STRIP_HEIGHT, h - top)
+                surface = cairo.ImageSurface(surface_format, w, strip_height)
+                context = cairo.Context(surface)
+                Gdk.cairo_set_source_pixbuf(context,
+                    self.view.new_subpixbuf(0, top, w, strip_height), 0, 0)
+                context.paint()
+                # draw the bubbles in whole-image coordinates; cairo throws
+                # away whatever doesn't land on this strip
+                context.translate(0, -top)
+                for (s2c, box, text, font), area, margin in zip(self.bubbles, areas, margins):
+                    if strip_overlaps(area, top, top + strip_height, margin):
+                        s2c.render_to_context_at_size_with_text(context, *area,
+                            text=text, font_name=font)
+                surface.flush()
+                strip = Gdk.pixbuf_get_from_surface(surface, 0, 0, w, strip_height)
+                del context, surface
+                if writer:
+                    writer.write_pixbuf(strip)
+                else:
+                    strip.copy_area(0, 0, w, strip_height, whole, 0, top)
+                self.check((i + 1) / (len(tops) + 1))
+        except:
+            if writer: writer.abort()
+            raise
+
+        if writer:
+            writer.close()
+            return self.filename
+        if self.format == "jpeg":
+            whole.savev(self.filename, "jpeg", ["quality"], [str(JPEG_QUALITY)])
+            return self.filename
+        return whole
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""Undo and redo.
+
+The history is a list of the edits that have been made (crop to here, add a
+bubble, move it, change its text), not a list of copies of the image after
+each one, so it costs next to nothing however big the photo is. The state of
+things after any number of edits is worked out by starting at the nearest
+checkpoint before it and replaying the edits from there.
+
+Anything expensive that's made from a state, like the flattened image for
+exporting, can be kept in the history's render cache. That holds as many
+renders as fit in its byte budget, and throws out the least recently used
+ones to make room; memory() says how much it's using.
+
+Apply is an edit too (Flatten): the picture after it is the flattened render
+of the state before it, which lives in the render cache, and is just made
+again if it's been thrown out by the time something needs it.
+"""
+
+from collections import OrderedDict, namedtuple
+import os
+import tracing
+from tracing import log
+
+# crop_rect is ((left, top), (right, bottom)) in fractions of the whole image,
+# and a bubble's box is (left, top, right, bottom) in fractions of the
+# cropped image (so a Crop works them out again, to keep bubbles where they
+# were on the photo). Everything's tuples, so states can be shared between
+# positions in the history without anyone changing them underneath.
+# base is None for the image as it was loaded, or, after an Apply, the
+# position whose ("flatten", position) render is the picture now.
+EditState = namedtuple("EditState", ["crop_rect", "bubbles", "base"], defaults=[None])
+Bubble = namedtuple("Bubble", ["s2c", "box", "text", "font"], defaults=["Impact"])
+
+def initial_state():
+    return EditState(crop_rect=((0.0, 0.0), (1.0, 1.0)), bubbles=())
+
+##################################################################
+# Edits
+##################################################################
+
+def _recrop(value, old_start, old_end, new_start, new_end):
+    """value, a fraction of the old crop one way, as a fraction of the new."""
+    return (old_start + value * (old_end - old_start) - new_start) / (new_end - new_start)
+
+class Crop(object):
+    name = "Crop"
+    def __init__(self, crop_rect):
+        self.crop_rect = tuple(tuple(corner) for corner in crop_rect)
+    def apply(self, state):
+        """Bubble boxes are fractions of the cropped image, so they're
+           worked out again for the new crop, to keep the bubbles on the
+           same bit of the photo."""
+        (ol, ot), (or_, ob) = state.crop_rect
+        (nl, nt), (nr, nb) = self.crop_rect
+        if nr <= nl or nb <= nt:
+            # nothing left to put them on, so leave them be
+            return state._replace(crop_rect=self.crop_rect)
+        bubbles = tuple(b._replace(box=(
+            _recrop(b.box[0], ol, or_, nl, nr), _recrop(b.box[1], ot, ob, nt, nb),
+            _recrop(b.box[2], ol, or_, nl, nr), _recrop(b.box[3], ot, ob, nt, nb)))
+            for b in state.bubbles)
+        return state._replace(crop_rect=self.crop_rect, bubbles=bubbles)
+
+class AddBubble(object):
+    name = "Add Bubble"
+    def __init__(self, s2c, box, text, font="Impact"):
+        self.bubble = Bubble(s2c, tuple(box), text, font)
+    def apply(self, state):
+        return state._replace(bubbles=state.bubbles + (self.bubble,))
+
+class SetBubbleBox(object):
+    def __init__(self, index, box, name="Move Bubble"):
+        self.index = index
+        self.box = tuple(box)
+        self.name = name
+    def apply(self, state):
+        bubbles = list(state.bubbles)
+        bubbles[self.index] = bubbles[self.index]._replace(box=self.box)
+        return state._replace(bubbles=tuple(bubbles))
+
+class SetBubbleText(object):
+    name = "Change Bubble Text"
+    def __init__(self, index, text):
+        self.index = index
+        self.text = text
+    def apply(self, state):
+        bubbles = list(state.bubbles)
+        bubbles[self.index] = bubbles[self.index]._replace(text=self.text)
+        return state._replace(bubbles=tuple(bubbles))
+
+class Flatten(object):
+    name = "Apply"
+    def __init__(self, position):
+        """Makes the ("flatten", position) render the picture, with no crop
+           and no bubbles on top, since they're all in it now."""
+        self.position = position
+    def apply(self, state):
+        return initial_state()._replace(base=self.position)
+
+##################################################################
+# The history itself
+##################################################################
+
+def render_size(render):
+    """Roughly how many bytes a render takes up."""
+    if hasattr(render, "get_rowstride"):
+        return render.get_rowstride() * render.get_height()
+    if hasattr(render, "get_stride"):
+        return render.get_stride() * render.get_height()
+    return len(render)
+
+def configured_render_budget():
+    """The render budget to use: GRAVEN_RENDER_BUDGET_MB megabytes if that's
+       set in the environment, and otherwise the default."""
+    setting = os.environ.get("GRAVEN_RENDER_BUDGET_MB")
+    if setting:
+        try:
+            return int(float(setting) * 1024 * 1024)
+        except ValueError:
+            log.warning("GRAVEN_RENDER_BUDGET_MB should be a number of megabytes, not '%s'", setting)
+    return History.DEFAULT_RENDER_BUDGET
+
+class History(object):
+    # keep every Nth state, so nothing has to replay more than N edits
+    CHECKPOINT_INTERVAL = 16
+    DEFAULT_RENDER_BUDGET = 128 * 1024 * 1024
+
+    def __init__(self, initial=None, render_budget=DEFAULT_RENDER_BUDGET):
+        self.operations = []
+        self.position = 0
+        self.state = initial or initial_state()
+        self.checkpoints = {0: self.state}
+        self.renders = OrderedDict() # (kind, position) -> (render, size)
+        self.render_budget = render_budget
+        self.render_bytes = 0
+
+    def do(self, operation):
+        """Applies an edit, and forgets anything that had been undone."""
+        self.truncate()
+        self.operations.append(operation)
+        self.position += 1
+        self.state = operation.apply(self.state)
+        if self.position % self.CHECKPOINT_INTERVAL == 0:
+            self.checkpoints[self.position] = self.state
+        return self.state
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.operations)
+
+    def undo_name(self):
+        return self.operations[self.position - 1].name if self.can_undo() else None
+
+    def redo_name(self):
+        return self.operations[self.position].name if self.can_redo() else None
+
+    def undo(self):
+        if not self.can_undo(): return self.state
+        self.position -= 1
+        self.state = self.state_at(self.position)
+        return self.state
+
+    def redo(self):
+        if not self.can_redo(): return self.state
+        self.state = self.operations[self.position].apply(self.state)
+        self.position += 1
+        return self.state
+
+    def state_at(self, position):
+        """The state after the first `position` edits, replayed from the
+           nearest checkpoint."""
+        start = position - (position % self.CHECKPOINT_INTERVAL)
+        state = self.checkpoints[start]
+        for operation in self.operations[start:position]:
+            state = operation.apply(state)
+        return state
+
+    def truncate(self):
+        if not self.can_redo(): return
+        del self.operations[self.position:]
+        for position in [p for p in self.checkpoints if p > self.position]:
+            del self.checkpoints[position]
+        for key in [k for k in self.renders if k[1] > self.position]:
+            self.forget_render(key)
+
+    ##################################################################
+    # Render cache
+    ##################################################################
+
+    def render(self, kind, make, position=None):
+        """A render of the state at position (by default, the current one):
+           the cached one if there is one, and otherwise make(state)."""
+        if position is None: position = self.position
+        key = (kind, position)
+        cached = self.renders.get(key)
+        if cached:
+            self.renders.move_to_end(key)
+            return cached[0]
+        with tracing.span("history.render", kind=kind, position=position):
+            render = make(self.state_at(position))
+        self.cache_render(key, render)
+        return render
+
+    def cache_render(self, key, render):
+        size = render_size(render)
+        if size > self.render_budget:
+            log.debug("Render %s (%s bytes) is bigger than the whole budget; not keeping it", key, size)
+            return
+        if key in self.renders: self.forget_render(key)
+        self.renders[key] = (render, size)
+        self.render_bytes += size
+        self.evict()
+
+    def forget_render(self, key):
+        render, size = self.renders.pop(key)
+        self.render_bytes -= size
+
+    def evict(self):
+        while self.render_bytes > self.render_budget:
+            self.forget_render(next(iter(self.renders)))
+
+    def set_render_budget(self, budget):
+        self.render_budget = budget
+        self.evict()
+
+    def memory(self):
+        """What the history is holding on to."""
+        return {
+            "render_budget": self.render_budget,
+            "render_bytes": self.render_bytes,
+            "renders": len(self.renders),
+            "operations": len(self.operations),
+            "position": self.position,
+            "checkpoints": len(self.checkpoints)
+        }
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""Loads an image in the background, a chunk at a time, so that a huge photo
+doesn't freeze everything while it's decoded. The image can be shown while
+it's still arriving: prepared() is called as soon as the loader knows how
+big the image is, and updated() as more of it is decoded into that pixbuf.
+
+BytesImageLoader does the same for an image that's already in memory, like
+a big screenshot pasted from the clipboard.
+"""
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, Gio, GLib
+import time
+import tracing
+from tracing import log
+
+class ImageLoader(object):
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, gfile, prepared=None, updated=None, progress=None, finished=None, failed=None):
+        """prepared(pixbuf): there's a (blank, so far) pixbuf for the image
+           updated(pixbuf, x, y, width, height): part of it has been decoded
+           progress(fraction): how far through the file we are; None if we
+               don't know how big the file is
+           finished(pixbuf): all done
+           failed(error): couldn't read or decode the file"""
+        self.gfile = gfile
+        self.name = gfile.get_uri() if gfile else None
+        self.prepared = prepared
+        self.updated = updated
+        self.progress = progress
+        self.finished = finished
+        self.failed = failed
+        self.cancellable = Gio.Cancellable()
+        self.loader = GdkPixbuf.PixbufLoader()
+        self.loader.connect("area-prepared", self.area_prepared)
+        self.loader.connect("area-updated", self.area_updated)
+        self.stream = None
+        self.total = 0
+        self.done = 0
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.gfile.query_info_async(Gio.FILE_ATTRIBUTE_STANDARD_SIZE, Gio.FileQueryInfoFlags.NONE,
+            GLib.PRIORITY_DEFAULT, self.cancellable, self.got_info, None)
+
+    def cancel(self):
+        if self.cancellable.is_cancelled(): return
+        log.debug("Cancelled loading %s", self.name)
+        self.cancellable.cancel()
+        self.close()
+
+    def close(self):
+        if self.stream:
+            self.stream.close_async(GLib.PRIORITY_DEFAULT, None, None, None)
+            self.stream = None
+        try:
+            self.loader.close()
+        except GLib.Error:
+            pass # it's fine to close a loader that's only got half an image
+
+    def got_info(self, f, res, data):
+        try:
+            self.total = f.query_info_finish(res).get_size()
+        except GLib.Error:
+            if self.cancellable.is_cancelled(): return
+            # no size (some remote files don't have one); carry on without
+            self.total = 0
+        f.read_async(GLib.PRIORITY_DEFAULT, self.cancellable, self.opened, None)
+
+    def opened(self, f, res, data):
+        try:
+            self.stream = f.read_finish(res)
+        except GLib.Error as e:
+            self.error(e)
+            return
+        self.read_next()
+
+    def read_next(self):
+        self.stream.read_bytes_async(self.CHUNK_SIZE, GLib.PRIORITY_DEFAULT, self.cancellable,
+            self.got_chunk, None)
+
+    def got_chunk(self, stream, res, data):
+        try:
+            chunk = stream.read_bytes_finish(res)
+            if chunk.get_size() == 0:
+                self.stream = None
+                stream.close_async(GLib.PRIORITY_DEFAULT, None, None, None)
+                self.loader.close()
+                self.complete()
+                return
+            self.loader.write_bytes(chunk)
+        except GLib.Error as e:
+            self.error(e)
+            return
+        self.done += chunk.get_size()
+        if self.progress:
+            self.progress(min(self.done / self.total, 1.0) if self.total else None)
+        self.read_next()
+
+    def area_prepared(self, loader):
+        if self.prepared: self.prepared(loader.get_pixbuf())
+
+    def area_updated(self, loader, x, y, width, height):
+        if self.updated: self.updated(loader.get_pixbuf(), x, y, width, height)
+
+    def complete(self):
+        if tracing.tracer.filename:
+            tracing.tracer.add("image.load", self.started, time.perf_counter(),
+                {"uri": self.name, "bytes": self.done})
+        if self.finished: self.finished(self.loader.get_pixbuf())
+
+    def error(self, e):
+        if self.cancellable.is_cancelled(): return
+        self.close()
+        log.error("Couldn't load %s: %s", self.name, e.message)
+        if self.failed: self.failed(e)
+
+class BytesImageLoader(ImageLoader):
+    def __init__(self, data, name="pasted image", **callbacks):
+        """data is the image file's contents, as bytes; the callbacks are
+           as for ImageLoader."""
+        ImageLoader.__init__(self, None, **callbacks)
+        self.data = data
+        self.name = name
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.total = len(self.data)
+        self.stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(self.data))
+        self.read_next()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+"""Operations on the image being edited which don't need a window, so that
+they can be used (and timed) without one."""
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf
+
+# crop_borders for "no crop at all"
+FULL_IMAGE = [[0.0, 0.0], [1.0, 1.0]]
+
+def crop_area(pb, crop_borders):
+    """The (x, y, width, height) in pixels of the part of pb inside
+       crop_borders, which is [[left, top], [right, bottom]] as fractions of
+       pb's width and height. It's kept inside pb, and at least a pixel big."""
+    w = pb.get_width()
+    h = pb.get_height()
+    left = min(max(int(crop_borders[0][0] * w), 0), w - 1)
+    top = min(max(int(crop_borders[0][1] * h), 0), h - 1)
+    right = min(max(int(crop_borders[1][0] * w), left + 1), w)
+    bottom = min(max(int(crop_borders[1][1] * h), top + 1), h)
+    return left, top, right - left, bottom - top
+
+def clamp_borders(crop_borders):
+    """crop_borders, with everything kept between 0 and 1."""
+    return [[min(max(v, 0.0), 1.0) for v in corner] for corner in crop_borders]
+
+def crop_view(pb, crop_borders):
+    """The part of pb inside crop_borders, without copying anything: the
+       pixbuf this returns shares pb's pixels."""
+    x, y, w, h = crop_area(pb, crop_borders)
+    if w == pb.get_width() and h == pb.get_height():
+        return pb
+    return pb.new_subpixbuf(x, y, w, h)
+
+def crop_pixbuf(pb, crop_borders):
+    """Returns a new pixbuf of the part of pb inside crop_borders, as a copy;
+       crop_view is the same thing without the copy."""
+    x, y, w, h = crop_area(pb, crop_borders)
+    new_pb = GdkPixbuf.Pixbuf.new(pb.get_colorspace(), pb.get_has_alpha(), pb.get_bits_per_sample(), w, h)
+    pb.copy_area(x, y, w, h, new_pb, 0, 0)
+    return new_pb
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""A mipmap pyramid for an image: the image itself, then half the size, a
+quarter, and so on down to thumbnail size. The canvas shows a screen-sized
+copy of the image, and making that from the level just bigger than the screen
+is much quicker than making it from the whole of a 40 megapixel photo; and
+because each level is exactly half the one above, it looks better, too.
+
+Building the pyramid is done in a thread, so it doesn't hold anything up.
+(GdkPixbuf lets go of the GIL while it's scaling.)
+"""
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, GLib
+import threading
+import imageops
+import tracing
+
+class Pyramid(object):
+    # stop halving once the image is this small in both directions
+    MIN_SIZE = 256
+
+    def __init__(self, source):
+        self.source = source
+        self.levels = [source]
+
+    def build(self):
+        with tracing.span("pyramid.build", width=self.source.get_width(),
+                height=self.source.get_height()):
+            level = self.source
+            while level.get_width() > self.MIN_SIZE or level.get_height() > self.MIN_SIZE:
+                level = level.scale_simple(max(1, level.get_width() // 2),
+                    max(1, level.get_height() // 2), GdkPixbuf.InterpType.BILINEAR)
+                self.levels.append(level)
+        return self
+
+    def scaled(self, width, height, crop_borders=imageops.FULL_IMAGE):
+        """The image, or the crop_borders part of it, at exactly width x height."""
+        for level in reversed(self.levels):
+            x, y, w, h = imageops.crop_area(level, crop_borders)
+            if w >= width and h >= height: break
+        view = imageops.crop_view(level, crop_borders)
+        if w == width and h == height:
+            return view
+        return view.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR)
+
+def build_async(source, callback, *args):
+    """Builds a Pyramid for source in a thread, and then calls
+       callback(pyramid, *args) back on the main thread."""
+    def work():
+        GLib.idle_add(done, Pyramid(source).build())
+    def done(pyramid):
+        callback(pyramid, *args)
+        return False
+    threading.Thread(target=work, daemon=True).start()
+
+def preview(source, width, height):
+    """A rough copy of source at width x height, for while there isn't a
+       pyramid. It only reads the pixels it keeps, so it's quick even for a
+       huge image."""
+    if source.get_width() == width and source.get_height() == height:
+        return source
+    return source.scale_simple(width, height, GdkPixbuf.InterpType.NEAREST)
+
+def fit(width, height, max_width, max_height):
+    """The size to show a width x height image at to fit it in max_width x
+       max_height. Small images aren't blown up past their real size."""
+    scale = min(float(max_width) / width, float(max_height) / height, 1.0)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale))), scale
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""Where the bubbles are on the canvas, so that working out which one is
+under the pointer, or which ones need drawing, doesn't mean checking every
+one of them. With dozens of captions on a picture that adds up.
+
+Things go into a uniform grid of square cells: each cell knows which things
+overlap it, so a point only has to be checked against the handful of things
+in its cell, and a region against the things in the cells it covers.
+Bubbles are stacked in the order they were added, so the last one is on
+top; the edited bubble's handles are above all of them.
+"""
+
+import math
+from collections import defaultdict
+
+def contains(rect, x, y):
+    return x > rect[0] and y > rect[1] and x < rect[0] + rect[2] and y < rect[1] + rect[3]
+
+def overlaps(a, b):
+    if a[2] <= 0 or a[3] <= 0 or b[2] <= 0 or b[3] <= 0: return False
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+class Grid(object):
+    CELL_SIZE = 64
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = defaultdict(set)
+        self.items = {} # key -> (rect, z)
+
+    def cells_for(self, rect):
+        size = self.cell_size
+        left = int(math.floor(rect[0] / size))
+        top = int(math.floor(rect[1] / size))
+        right = int(math.floor((rect[0] + max(rect[2], 0)) / size))
+        bottom = int(math.floor((rect[1] + max(rect[3], 0)) / size))
+        for cx in range(left, right + 1):
+            for cy in range(top, bottom + 1):
+                yield (cx, cy)
+
+    def put(self, key, rect, z):
+        """Adds key at rect (x, y, w, h), or moves it there. A rect with no
+           width or height, or less (like a bubble whose top left has been
+           dragged past its bottom right), covers nothing, so it's never
+           hit and never overlaps anything, just as nothing's drawn for it."""
+        self.remove(key)
+        self.items[key] = (tuple(rect), z)
+        for cell in self.cells_for(rect):
+            self.cells[cell].add(key)
+
+    def remove(self, key):
+        if key not in self.items: return
+        rect, z = self.items.pop(key)
+        for cell in self.cells_for(rect):
+            self.cells[cell].discard(key)
+            if not self.cells[cell]: del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self.items.clear()
+
+    def at(self, x, y):
+        """The topmost key whose rect contains x, y, or None."""
+        cell = (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+        hits = [key for key in self.cells.get(cell, ()) if contains(self.items[key][0], x, y)]
+        if not hits: return None
+        return max(hits, key=lambda key: self.items[key][1])
+
+    def overlapping(self, rect):
+        """Keys whose rects overlap rect, bottom first."""
+        found = set()
+        for cell in self.cells_for(rect):
+            found.update(self.cells.get(cell, ()))
+        return sorted((key for key in found if overlaps(self.items[key][0], rect)),
+            key=lambda key: self.items[key][1])
+
+class Scene(object):
+    """The bubbles on the canvas, as ("bubble", index) keys, and the edited
+       bubble's resize handles, as ("handle", "tl" or "br")."""
+    def __init__(self):
+        self.grid = Grid()
+        self.count = 0
+
+    def set_bubbles(self, rects):
+        """rects is every bubble's x, y, w, h on the canvas, bottom first."""
+        self.grid.clear()
+        self.count = len(rects)
+        for index, rect in enumerate(rects):
+            self.grid.put(("bubble", index), rect, index)
+
+    def move_bubble(self, index, rect):
+        self.grid.put(("bubble", index), rect, index)
+
+    def set_handles(self, handles):
+        """handles is a list of (rect, "tl" or "br")."""
+        for key in [k for k in self.grid.items if k[0] == "handle"]:
+            self.grid.remove(key)
+        for number, (rect, loc) in enumerate(handles):
+            # above every bubble; there are two rectangles to each handle
+            self.grid.put(("handle", loc, number), rect, self.count + number)
+
+    def hit(self, x, y):
+        """What's under x, y: ("handle", loc), ("bubble", index), or None."""
+        key = self.grid.at(x, y)
+        return key[:2] if key else None
+
+    def bubbles_in(self, rect):
+        """The indexes of the bubbles overlapping rect, bottom first."""
+        return [key[1] for key in self.grid.overlapping(rect) if key[0] == "bubble"]
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+"""Ready-drawn pictures of bubbles, for while one's being dragged about.
+
+Moving a bubble doesn't change its size or its text, so there's no need to
+replay all its drawing instructions and fit its text again every frame: draw
+it once onto an image surface, and then just paint that wherever the bubble
+has got to. It's a little soft if it lands between pixels, so bubbles are
+drawn properly again once the drag's over.
+"""
+
+import math
+from collections import OrderedDict
+import cairo
+import tracing
+
+class SpriteCache(object):
+    MAX_SPRITES = 32
+
+    def __init__(self, margin=0):
+        """margin is how far outside its box a bubble can draw; sprites
+           have that much room spare all round."""
+        self.margin = margin
+        self.sprites = OrderedDict()
+
+    def sprite(self, s2c, width, height, text, font_name, device_scale=1):
+        """A surface with s2c drawn on it at width x height (plus the margin),
+           made if there isn't one already."""
+        key = (s2c, int(round(width)), int(round(height)), text, font_name, device_scale)
+        sprite = self.sprites.get(key)
+        if sprite:
+            self.sprites.move_to_end(key)
+            return sprite
+        with tracing.span("sprite.render", width=key[1], height=key[2]):
+            sprite = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                int(math.ceil((key[1] + self.margin * 2) * device_scale)),
+                int(math.ceil((key[2] + self.margin * 2) * device_scale)))
+            sprite.set_device_scale(device_scale, device_scale)
+            context = cairo.Context(sprite)
+            s2c.render_to_context_at_size_with_text(context, self.margin, self.margin,
+                key[1], key[2], text, font_name)
+            sprite.flush()
+        self.sprites[key] = sprite
+        while len(self.sprites) > self.MAX_SPRITES:
+            self.sprites.popitem(last=False)
+        return sprite
+
+    def draw(self, context, s2c, x, y, width, height, text, font_name, device_scale=1):
+        """Paints s2c into the box at x, y, width x height, from its sprite."""
+        sprite = self.sprite(s2c, width, height, text, font_name, device_scale)
+        # put it on a whole device pixel, so it's copied rather than resampled
+        x = round((x - self.margin) * device_scale) / device_scale
+        y = round((y - self.margin) * device_scale) / device_scale
+        context.set_source_surface(sprite, x, y)
+        context.paint()
+
+    def clear(self):
+        self.sprites.clear()
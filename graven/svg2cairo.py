@@ -7,13 +7,294 @@ import gi
 gi.require_version('PangoCairo', '1.0')
 gi.require_version('Pango', '1.0')
 from gi.repository import Gio, Pango, PangoCairo
-from xml.dom import minidom
+from xml.etree import ElementTree
+from collections import OrderedDict
+import io
+import re
 import sys
+import math
+import threading
 import cairo
+import tracing
 
-def fit_text(text, font_name, max_width, max_height):
+# Bump this whenever convert() starts producing different instructions, so
+# that anything which has stored converted bubbles (like the bubble pack)
+# knows to throw them away.
+CONVERTER_VERSION = 6
+
+# Path data is split into one segment per command letter. Most segments are
+# just numbers separated by spaces and commas, which split() and float() deal
+# with quickly; but numbers can also run together without separators ("1.5.5"
+# is two numbers, "10-5" is two numbers), in which case the segment is read
+# a number at a time instead. A number has to be whole: "1e" with no
+# exponent is a mistake, not a 1. Arc flags are single digits which can run together
+# too ("a5 5 0 015 5"), so arc segments get their own pattern which reads a
+# whole arc at a time.
+PATH_COMMANDS = "MmZzLlHhVvCcSsQqTtAa"
+PATH_SEGMENT = re.compile(r"([%s])([^%s]*)" % (PATH_COMMANDS, PATH_COMMANDS))
+_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+PATH_NUMBER = re.compile(_NUMBER)
+PATH_NOT_NUMBERS = re.compile(r"[^\d\s,.eE+-]")
+PATH_ARC = re.compile(r"[\s,]*(N)[\s,]*(N)[\s,]*(N)[\s,]*([01])[\s,]*([01])[\s,]*(N)[\s,]*(N)".replace("N", _NUMBER))
+PATH_END = re.compile(r"[\s,]*$")
+PATH_SEPARATORS = re.compile(r"[\s,]*")
+TRANSFORM_FUNCTION = re.compile(r"\s*,?\s*(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)")
+PATH_ARGUMENT_COUNTS = {"M": 2, "L": 2, "H": 1, "V": 1, "C": 6, "S": 4, "Q": 4, "T": 2, "A": 7, "Z": 0}
+
+def read_path_numbers(argstring):
+    """Reads numbers which may be run together, for when split() won't do.
+       Returns the numbers, and whether that was all there was; it stops at
+       anything which isn't a whole number, like "1e" with no exponent."""
+    numbers = []
+    pos = PATH_SEPARATORS.match(argstring).end()
+    while pos < len(argstring):
+        m = PATH_NUMBER.match(argstring, pos)
+        if not m or argstring[m.end():m.end() + 1] in ("e", "E"): return numbers, False
+        numbers.append(float(m.group()))
+        pos = PATH_SEPARATORS.match(argstring, m.end()).end()
+    return numbers, True
+
+def _arc_angle(ux, uy, vx, vy):
+    return math.atan2(ux * vy - uy * vx, ux * vx + uy * vy)
+
+def arc_to_curves(x1, y1, rx, ry, rotation, large_arc, sweep, x2, y2):
+    """Converts an SVG elliptical arc into curve_to instructions, one per
+       quarter-turn or less, using the endpoint-to-centre conversion from
+       the SVG spec's implementation notes."""
+    if x1 == x2 and y1 == y2: return []
+    rx = abs(rx)
+    ry = abs(ry)
+    if rx == 0 or ry == 0: return [["line_to", [x2, y2]]]
+    cos_phi = math.cos(math.radians(rotation))
+    sin_phi = math.sin(math.radians(rotation))
+    dx = (x1 - x2) / 2
+    dy = (y1 - y2) / 2
+    x1p = cos_phi * dx + sin_phi * dy
+    y1p = -sin_phi * dx + cos_phi * dy
+    # radii too small to reach the end point get scaled up until they do
+    radii_check = (x1p * x1p) / (rx * rx) + (y1p * y1p) / (ry * ry)
+    if radii_check > 1:
+        rx *= math.sqrt(radii_check)
+        ry *= math.sqrt(radii_check)
+    numerator = rx * rx * ry * ry - rx * rx * y1p * y1p - ry * ry * x1p * x1p
+    denominator = rx * rx * y1p * y1p + ry * ry * x1p * x1p
+    coef = math.sqrt(max(numerator, 0) / denominator) if denominator else 0
+    if large_arc == sweep: coef = -coef
+    cxp = coef * rx * y1p / ry
+    cyp = -coef * ry * x1p / rx
+    cx = cos_phi * cxp - sin_phi * cyp + (x1 + x2) / 2
+    cy = sin_phi * cxp + cos_phi * cyp + (y1 + y2) / 2
+    ux = (x1p - cxp) / rx
+    uy = (y1p - cyp) / ry
+    theta = _arc_angle(1, 0, ux, uy)
+    dtheta = _arc_angle(ux, uy, (-x1p - cxp) / rx, (-y1p - cyp) / ry)
+    if not sweep and dtheta > 0:
+        dtheta -= 2 * math.pi
+    elif sweep and dtheta < 0:
+        dtheta += 2 * math.pi
+    segments = max(int(math.ceil(abs(dtheta) / (math.pi / 2) - 1e-9)), 1)
+    delta = dtheta / segments
+    t = 4 / 3 * math.tan(delta / 4)
+
+    def point(px, py):
+        return [cx + rx * px * cos_phi - ry * py * sin_phi, cy + rx * px * sin_phi + ry * py * cos_phi]
+
+    instructions = []
+    for i in range(segments):
+        a1 = theta + i * delta
+        a2 = a1 + delta
+        c1, s1, c2, s2 = math.cos(a1), math.sin(a1), math.cos(a2), math.sin(a2)
+        instructions.append(["curve_to", point(c1 - t * s1, s1 + t * c1) +
+            point(c2 + t * s2, s2 - t * c2) + point(c2, s2)])
+    # make sure we finish exactly where we were asked to, not nearly there
+    instructions[-1][1][4:6] = [x2, y2]
+    return instructions
+
+class FitTextCache(object):
+    """A small LRU cache of fitted font sizes.
+
+       fit_text gets called on every redraw of a bubble, and the text and
+       box almost never change between redraws, so there's no point searching
+       for the right font size again each time. Entries are keyed on
+       (text, font name, width, height), with the box dimensions quantized to
+       QUANTUM pixels so that tiny changes in box size share an entry; the
+       size kept is the one fitted to the first box to ask, which for a
+       bubble is always its own textbox anyway.
+    """
+    QUANTUM = 4
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        # bubbles get fitted by exports in the background as well as by the
+        # drawing on the main thread
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+
+    def key(self, text, font_name, max_width, max_height):
+        return (text, font_name, int(max_width // self.QUANTUM), int(max_height // self.QUANTUM))
+
+    def get(self, key):
+        with self.lock:
+            size = self.entries.get(key)
+            if size is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return size
+
+    def put(self, key, size):
+        with self.lock:
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def nearest(self, key):
+        """Returns a guess at the font size for key, scaled from the cached entry
+           with the same text and font whose box is closest in size, or None."""
+        text, font_name, qw, qh = key
+        best = None
+        with self.lock:
+            entries = list(self.entries.items())
+        for (etext, efont, ew, eh), size in entries:
+            if etext != text or efont != font_name or ew == 0 or eh == 0: continue
+            distance = abs(ew - qw) + abs(eh - qh)
+            if best is None or distance < best[0]:
+                best = (distance, int(size * min(qw / ew, qh / eh)))
+        if best: return best[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = self.probes = 0
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "probes": self.probes,
+            "size": len(self.entries), "maxsize": self.maxsize}
+
+fit_cache = FitTextCache()
+_font_families = None
+
+def font_families():
+    """The set of font family names Pango knows about. Asking the font map
+       for this is slow, so it's only done once."""
+    global _font_families
+    if _font_families is None:
+        fm = PangoCairo.font_map_get_default()
+        _font_families = frozenset(x.get_name() for x in fm.list_families())
+    return _font_families
+
+def _measure(ly, fd, size, max_width, max_height):
+    """Sets ly to size and returns whether it fits, along with how big it is
+       relative to the box. The ratio is worked out from the layout's extents
+       in Pango units rather than pixels, so it's precise enough to
+       extrapolate from; a ratio of 1 is right on the edge of fitting."""
+    fd.set_absolute_size(size)
+    ly.set_font_description(fd)
+    s = ly.get_pixel_size()
+    fit_cache.probes += 1
+    fits = s.width < max_width and s.height < max_height
+    # the biggest pixel size that fits is one less than the box rounded up
+    w, h = ly.get_size()
+    ratio = max(w / (max(math.ceil(max_width) - 1, 1) * Pango.SCALE),
+        h / (max(math.ceil(max_height) - 1, 1) * Pango.SCALE))
+    return fits, ratio
+
+def _solve_font_size(ly, fd, max_width, max_height, start):
+    """Finds the biggest integer font size for which ly still fits.
+
+       The size of a piece of text is very nearly proportional to its font
+       size, so we measure once at start and extrapolate to where it'd just
+       fit. After that we keep the biggest size known to fit and the smallest
+       known not to, and interpolate between them to pick the next size to
+       try; that's usually right first time, give or take one, so it takes
+       three or four measurements all told.
+
+       Hinting makes the size go up in whole pixel steps instead, and it's
+       the same all along a step, so nothing we measure can say where in a
+       step the answer is: once a size that fits measures right on the edge,
+       we go by the smallest size that doesn't fit for as long as that
+       closes in, and then bisect. Finding the end of a step to the exact
+       size that way takes about log2 of the step's length in Pango units,
+       so hinted text takes more like a dozen measurements, and now and
+       then (small text, with a start a long way off) as many as the old
+       doubling-and-bisecting search did, or a couple more.
+
+       Either way we only stop when we have a size that fits and the next
+       size up which doesn't, so the answer is the same one a plain binary
+       search would find."""
+    fits_size, fits_ratio = 0, 0.0
+    too_big_size, too_big_ratio = None, None
+    candidate = start
+    same_side = 0 # how many probes in a row have fitted, before we overflow
+    gap = None
+    stepped = False # seen a size that fits right on the edge
+    extrapolated_from = None
+    while True:
+        if fits_size > 10000000:
+            print("Got stuck finding font size; crashing")
+            sys.exit(1)
+        fits, ratio = _measure(ly, fd, candidate, max_width, max_height)
+        if fits:
+            same_side += 1
+            fits_size, fits_ratio = candidate, ratio
+        else:
+            too_big_size, too_big_ratio = candidate, ratio
+        if too_big_size is not None and too_big_size - fits_size <= 1:
+            break
+        if fits and ratio >= 1 and not stepped:
+            # right on the edge; without hinting that's nearly always the
+            # answer, so try the next size up before anything else
+            stepped = True
+            reach = max(fits_size >> 8, 1)
+            candidate = fits_size + 1
+            continue
+        if too_big_size is None:
+            # everything so far fits; extrapolate from the biggest, and make
+            # sure we go further each time in case we're on a flat bit
+            candidate = int(fits_size / fits_ratio) if fits_ratio > 0 else fits_size * 2
+            candidate = max(candidate, fits_size + (fits_size >> max(9 - same_side, 0)) + 1)
+            continue
+        if stepped:
+            # what fits is on the edge, so only the too-big side can say
+            # where the edge is, and only the first time we hear from it
+            candidate = int(too_big_size / too_big_ratio) if too_big_size != extrapolated_from else 0
+            extrapolated_from = too_big_size
+            if not fits_size < candidate < too_big_size:
+                # it's most likely a step or two above what fits, so look
+                # there first, further each time it still fits
+                if fits: reach *= 2
+                candidate = min(fits_size + reach, (fits_size + too_big_size) // 2)
+            continue
+        previous_gap, gap = gap, too_big_size - fits_size
+        if (previous_gap and gap * 2 > previous_gap) or too_big_ratio <= fits_ratio:
+            # that guess didn't close in much, so bisect
+            candidate = (fits_size + too_big_size) // 2
+            gap = None
+        else:
+            candidate = int(fits_size + (too_big_size - fits_size) *
+                (1 - fits_ratio) / (too_big_ratio - fits_ratio))
+            candidate = min(max(candidate, fits_size + 1), too_big_size - 1)
+    return max(fits_size, 1)
+
+def new_text_layout():
+    """A Pango.Layout set up the way fit_text wants it, on a Pango context of
+       its own, so it can be kept and reused for every fit_text call."""
+    ly = Pango.Layout.new(PangoCairo.font_map_get_default().create_context())
+    ly.set_single_paragraph_mode(False)
+    ly.set_alignment(Pango.Alignment.CENTER)
+    return ly
+
+@tracing.traced("svg.fit_text")
+def fit_text(text, font_name, max_width, max_height, layout=None):
     """Given some text and a font name, returns a Pango.Layout which is as
        big as possible but still smaller than max_width x max_height.
+       Font sizes are remembered in fit_cache, so asking again for the same
+       text in the same box doesn't measure anything. Pass a layout from
+       new_text_layout() to have it reused rather than making a new one.
 
        Example usage:
        ly = fit_text("The mask.\nThe ray-traced picture.\nAnd finally,\nthe wireframe city.", "Impact", 800, 800)
@@ -23,64 +304,189 @@ def fit_text(text, font_name, max_width, max_height):
        PangoCairo.show_layout(base_context, ly)
        base.write_to_png("mytext.png")
     """
-    fm = PangoCairo.font_map_get_default()
-    fonts = [x.get_name() for x in fm.list_families()]
-    if font_name not in fonts:
+    if font_name not in font_families():
         raise Exception("Font name '%s' isn't on the fonts list" % font_name)
-    ctx = fm.create_context()
-    ly = Pango.Layout.new(ctx)
+    ly = layout or new_text_layout()
+    if ly.get_text() != text:
+        ly.set_text(text, -1)
     fd = Pango.FontDescription.new()
-    ly.set_single_paragraph_mode(False)
-    ly.set_alignment(Pango.Alignment.CENTER)
     fd.set_family(font_name)
-    ly.set_text(text, -1)
-    # now, binary search to find the biggest integer font size that still fits
-    # first, quickly find a setting which is bigger than the right size
-    size = 100
-    loopcount = 0
-    while 1:
-        loopcount += 1
-        if loopcount > 10000:
-            print("Got stuck finding font size; crashing")
-            sys.exit(1)
-        fd.set_absolute_size(size)
-        ly.set_font_description(fd)
-        s = ly.get_pixel_size()
-        if s.width > max_width or s.height > max_height:
-            # this one is bigger, so it's our start point for binary search
-            break
-        # this one's smaller, so double it and start again
-        size = size * 2
-    # now, binary search; we know this one's too big
-    first = 0
-    last = size
-    found = False
-    loopcount = 1
-    while first <= last:
-        loopcount += 1
-        if loopcount > 10000:
-            print("Got stuck finding font size; crashing")
-            sys.exit(1)
-        midpoint = ((first + last) // 2)
-        fd.set_absolute_size(midpoint)
-        ly.set_font_description(fd)
-        s = ly.get_pixel_size()
-        if s.width < max_width and s.height < max_height:
-            first = midpoint + 1
-        else:
-            last = midpoint - 1
+
+    key = fit_cache.key(text, font_name, max_width, max_height)
+    size = fit_cache.get(key)
+    if size is None:
+        # solve for the box we were actually given, not the rounded one in
+        # the key, so the size is the same one the old search would find. If
+        # a bubble of about this size has been fitted before, the answer is
+        # probably close to that one; if not, start anywhere and extrapolate
+        guess = fit_cache.nearest(key)
+        size = _solve_font_size(ly, fd, max_width, max_height, max(guess or 64 * Pango.SCALE, 1))
+        fit_cache.put(key, size)
+    fd.set_absolute_size(size)
+    ly.set_font_description(fd)
     return ly
 
+# Instructions which add to the current path, and which paint it
+PATH_OPS = ("move_to", "line_to", "curve_to", "close_path", "rectangle",
+    "rel_move_to", "rel_line_to", "rel_curve_to", "arc", "new_path")
+PAINT_OPS = ("fill", "stroke", "fill_preserve", "stroke_preserve")
+STATE_OPS = ("set_line_width", "set_source_rgba")
+def _remove_dead_line_widths(instructions):
+    """Drops set_line_widths which are changed again before anything strokes.
+       Works backwards, and keeps anything near a save or restore rather than
+       trying to be clever about them."""
+    out = []
+    needed = False
+    for cmd, params in reversed(instructions):
+        if cmd in ("stroke", "stroke_preserve", "save", "restore"):
+            needed = True
+        elif cmd == "set_line_width":
+            if not needed: continue
+            needed = False
+        out.append([cmd, params])
+    out.reverse()
+    return out
+
+def _split_shapes(instructions):
+    """Splits instructions into ("shape", path, paint) items, where path is a
+       run of path instructions and paint the state changes and painting
+       which follow it, and ("other", [instruction]) for anything else."""
+    items = []
+    i = 0
+    n = len(instructions)
+    while i < n:
+        j = i
+        while j < n and instructions[j][0] in PATH_OPS: j += 1
+        k = j
+        while k < n and instructions[k][0] in STATE_OPS + PAINT_OPS:
+            k += 1
+            if instructions[k - 1][0] in ("fill", "stroke"): break
+        if j > i and k > j and instructions[k - 1][0] in ("fill", "stroke"):
+            items.append(("shape", instructions[i:j], instructions[j:k]))
+            i = k
+        else:
+            items.append(("other", [instructions[i]], None))
+            i += 1
+    return items
+
+def _path_bounds(path):
+    xs = []
+    ys = []
+    for cmd, params in path:
+        if cmd in ("move_to", "line_to", "curve_to"):
+            xs += params[0::2]
+            ys += params[1::2]
+        elif cmd == "rectangle":
+            xs += [params[0], params[0] + params[2]]
+            ys += [params[1], params[1] + params[3]]
+        elif cmd != "close_path":
+            return None # relative or arcs; don't know, don't care
+    if xs: return (min(xs), min(ys), max(xs), max(ys))
+
+def _can_merge(a, b):
+    """Whether two shapes can be painted as one. They have to paint the same
+       way with a single opaque fill or stroke. Strokes are per subpath so
+       anything goes; fills are merged only when the shapes don't overlap,
+       because overlapping subpaths wound in opposite directions would leave
+       a hole under the nonzero fill rule."""
+    if a[2] != b[2]: return False
+    paints = [cmd for cmd, params in a[2] if cmd in PAINT_OPS]
+    if len(paints) != 1: return False
+    for cmd, params in a[2]:
+        if cmd == "set_source_rgba" and params[3] < 1: return False
+    if paints[0] == "stroke": return True
+    ba = _path_bounds(a[1])
+    bb = _path_bounds(b[1])
+    if not ba or not bb: return False
+    return ba[2] < bb[0] or bb[2] < ba[0] or ba[3] < bb[1] or bb[3] < ba[1]
+
+def _merge_shapes(instructions):
+    merged = []
+    for item in _split_shapes(instructions):
+        if merged and item[0] == "shape" and merged[-1][0] == "shape" and _can_merge(merged[-1], item):
+            merged[-1] = ("shape", merged[-1][1] + item[1], merged[-1][2])
+        else:
+            merged.append(item)
+    out = []
+    for kind, path, paint in merged:
+        out += path
+        if paint: out += paint
+    return out
+
+def _remove_redundant_state(instructions):
+    """Drops set_line_width and set_source_rgba calls which set what's already
+       set, keeping track of save and restore."""
+    out = []
+    state = {}
+    stack = []
+    for cmd, params in instructions:
+        if cmd == "save":
+            stack.append(dict(state))
+        elif cmd == "restore":
+            state = stack.pop() if stack else {}
+        elif cmd in STATE_OPS:
+            if state.get(cmd) == params: continue
+            state[cmd] = params
+        out.append([cmd, params])
+    return out
+
+def optimize_instructions(instructions):
+    """Makes a converted instruction list cheaper to replay without changing
+       what it draws: line widths nobody strokes with are dropped,
+       neighbouring shapes which paint the same way are painted together, and
+       state changes which change nothing are removed. Since nothing needs a
+       line width or colour until it's used, constant state naturally ends up
+       set just once, at its first use.
+       (Ellipses are left as cairo arcs. Four Bezier curves are a bit out,
+       about 0.03% of the radius, which is a visible fraction of a pixel on a
+       big bubble, and cairo's own arcs are made to be within a tenth of one.)"""
+    instructions = _remove_dead_line_widths(instructions)
+    instructions = _merge_shapes(instructions)
+    instructions = _remove_redundant_state(instructions)
+    return instructions
+
+def _is_identity(matrix):
+    return (matrix.xx == 1 and matrix.yy == 1 and matrix.xy == 0 and matrix.yx == 0 and
+        matrix.x0 == 0 and matrix.y0 == 0)
+
 class SVG2Cairo(object):
     IGNORE_ELEMENTS = ["defs", "metadata", "sodipodi:namedview"]
+    # elements which don't draw anything themselves, but whose transform
+    # applies to everything inside them
+    GROUP_ELEMENTS = ["g"]
+    # Compiled recordings have their line widths baked in, so we keep one per
+    # bucket of render scales; this many buckets per doubling of the scale
+    # keeps line widths within about 5% of what they should be.
+    SCALE_BUCKETS_PER_DOUBLING = 8
+    MAX_RECORDINGS = 8
+    # nothing is drawn smaller than this; it's just to keep log2 happy
+    MIN_SCALE = 1e-6
+    # we never set a line join, so corners get cairo's default miter join,
+    # whose points can stick out this many half line widths past the path
+    MITER_LIMIT = 10
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, compiled=False, optimize=True):
         self.svg_string = None
         self.debug = debug
+        self.optimize = optimize
         self.converted_result = None
+        self.pack_entry = None
+        self.layout = None
+        # In compiled mode we replay the instructions once onto a recording
+        # surface and then just paint that, rather than making a Python call
+        # per instruction on every frame. Needs cairo 1.10 or better.
+        self.compiled = compiled and hasattr(cairo, "RecordingSurface")
+        self.recordings = OrderedDict()
 
     def set_svg_as_string_sync(self, svg_string):
         self.svg_string = svg_string
+        self.recordings.clear()
+
+    def set_pack_entry(self, entry):
+        """Use an already-converted bubble from a bubble pack rather than
+           parsing an SVG; it's only decoded when first drawn."""
+        self.pack_entry = entry
+        self.recordings.clear()
 
     def set_svg_as_filename_async(self, filename):
         # This function assumes you have a gtk mainloop running somewhere
@@ -102,27 +508,82 @@ class SVG2Cairo(object):
             print("Unknown colour '%s'" % (hexcol,))
 
     def read_transform(self, transform_string):
-        # Not at _all_ convinced that this works right.
-        # If you can possibly avoid it, don't have transform attributes in your bubble SVGs.
-        # In inkscape, a good way to avoid this is to not put anything in any groups at
-        # all, including the layers. Just delete them. And save as simple SVG, not inkscape.
-        v = transform_string.strip()
-        if not v.startswith("matrix(") or not v.endswith(")"):
-            if self.debug:
-                print("Couldn't understand transform attribute '%s'" % (val,))
-            return
-        v = v[7:-1]
-        try:
-            parts = [float(x.strip()) for x in v.split(",")]
-        except:
-            if self.debug:
-                print("Couldn't understand transform attribute '%s'" % (val,))
-            return
-        if len(parts) != 6:
-            if self.debug:
-                print("Couldn't understand transform attribute '%s'" % (val,))
-            return
-        return cairo.Matrix(*parts)
+        """Reads a transform attribute (any list of matrix, translate, scale,
+           rotate, skewX and skewY) into one cairo.Matrix."""
+        result = cairo.Matrix()
+        pos = 0
+        while not PATH_END.match(transform_string, pos):
+            m = TRANSFORM_FUNCTION.match(transform_string, pos)
+            if not m:
+                if self.debug:
+                    print("Couldn't understand transform attribute '%s'" % (transform_string,))
+                return
+            pos = m.end()
+            name = m.group(1)
+            args = [float(v) for v in PATH_NUMBER.findall(m.group(2))]
+            if name == "matrix" and len(args) == 6:
+                t = cairo.Matrix(*args)
+            elif name == "translate" and len(args) in (1, 2):
+                t = cairo.Matrix(x0=args[0], y0=args[1] if len(args) == 2 else 0)
+            elif name == "scale" and len(args) in (1, 2):
+                t = cairo.Matrix(xx=args[0], yy=args[-1])
+            elif name == "rotate" and len(args) in (1, 3):
+                t = cairo.Matrix.init_rotate(math.radians(args[0]))
+                if len(args) == 3:
+                    # rotate about a point: move it to the origin, rotate, move it back
+                    t = cairo.Matrix(x0=-args[1], y0=-args[2]).multiply(t).multiply(
+                        cairo.Matrix(x0=args[1], y0=args[2]))
+            elif name == "skewX" and len(args) == 1:
+                t = cairo.Matrix(xy=math.tan(math.radians(args[0])))
+            elif name == "skewY" and len(args) == 1:
+                t = cairo.Matrix(yx=math.tan(math.radians(args[0])))
+            else:
+                if self.debug:
+                    print("Couldn't understand transform attribute '%s'" % (transform_string,))
+                return
+            # the rightmost transform in the list applies first
+            result = t.multiply(result)
+        return result
+
+    def bake_transform(self, instructions, matrix):
+        """Applies matrix to the coordinates in instructions, so that they can
+           be drawn without changing cairo's matrix. Ellipses which would be
+           rotated or skewed keep their arc, with the matrix applied inside
+           their save/restore; curves would only be nearly the same shape."""
+        axis_aligned = matrix.xy == 0 and matrix.yx == 0
+        out = []
+        in_ellipse = False
+        for cmd, params in instructions:
+            if not axis_aligned and (in_ellipse or cmd == "save"):
+                # parse_ellipse's save/restore block is left as it is, with
+                # the matrix in it
+                out.append([cmd, params])
+                if cmd == "save":
+                    out.append(["transform", [matrix]])
+                in_ellipse = cmd != "restore"
+                continue
+            if cmd in ("move_to", "line_to", "curve_to", "translate"):
+                points = []
+                for i in range(0, len(params), 2):
+                    points += matrix.transform_point(params[i], params[i + 1])
+                out.append([cmd, points])
+            elif cmd == "scale":
+                # only in ellipses, which only get here when axis-aligned
+                out.append(["scale", [params[0] * matrix.xx, params[1] * matrix.yy]])
+            elif cmd == "rectangle":
+                x, y, w, h = params
+                if axis_aligned:
+                    x, y = matrix.transform_point(x, y)
+                    out.append(["rectangle", [x, y, w * matrix.xx, h * matrix.yy]])
+                else:
+                    out.append(["move_to", list(matrix.transform_point(x, y))])
+                    out.append(["line_to", list(matrix.transform_point(x + w, y))])
+                    out.append(["line_to", list(matrix.transform_point(x + w, y + h))])
+                    out.append(["line_to", list(matrix.transform_point(x, y + h))])
+                    out.append(["close_path", []])
+            else:
+                out.append([cmd, params])
+        return out
 
     def read_style(self, style_string):
         items = [x.strip() for x in style_string.split(";")]
@@ -157,9 +618,9 @@ class SVG2Cairo(object):
 
     def expect(self, node, attrs):
         for a in attrs:
-            if not node.hasAttribute(a):
+            if a not in node.attrib:
                 if self.debug:
-                    print("Expected node <%s> to have attribute '%s'" % (node.nodeName, a))
+                    print("Expected node <%s> to have attribute '%s'" % (node.tag, a))
                 return False
         return True
 
@@ -171,10 +632,10 @@ class SVG2Cairo(object):
         # https://www.cairographics.org/documentation/pycairo/2/reference/context.html#cairo.Context.arc
         # so actually thanks for that, Cairo docs people.
         if not self.expect(node, ["cx", "cy", "rx", "ry"]): return
-        cx = float(node.getAttribute("cx"))
-        cy = float(node.getAttribute("cy"))
-        rx = float(node.getAttribute("rx"))
-        ry = float(node.getAttribute("ry"))
+        cx = float(node.get("cx"))
+        cy = float(node.get("cy"))
+        rx = float(node.get("rx"))
+        ry = float(node.get("ry"))
 
         ellipse_x = cx - rx
         ellipse_y = cy - ry
@@ -191,67 +652,164 @@ class SVG2Cairo(object):
 
     def parse_rect(self, node):
         if not self.expect(node, ["x", "y", "width", "height"]): return
-        x = float(node.getAttribute("x"))
-        y = float(node.getAttribute("y"))
-        width = float(node.getAttribute("width"))
-        height = float(node.getAttribute("height"))
+        x = float(node.get("x"))
+        y = float(node.get("y"))
+        width = float(node.get("width"))
+        height = float(node.get("height"))
         return [
             ["rectangle", [x, y, width, height]]
         ]
 
+    def read_path_arguments(self, upper, argstring):
+        """Returns the numbers in one path segment, grouped up into one list per
+           repeat of the command, and whether they all made sense."""
+        if upper == "A":
+            groups = []
+            pos = 0
+            while not PATH_END.match(argstring, pos):
+                m = PATH_ARC.match(argstring, pos)
+                # an exponent with no digits ("5e") ends the arc's last number early
+                if not m or argstring[m.end():m.end() + 1] in ("e", "E"): return groups, False
+                groups.append([float(v) for v in m.groups()])
+                pos = m.end()
+            return groups, len(groups) > 0
+        count = PATH_ARGUMENT_COUNTS[upper]
+        if count == 0:
+            return [[]], PATH_END.match(argstring) is not None
+        # anything that can't be part of a number (like a letter which isn't
+        # a command) ends the path, but whatever came before it still counts
+        bad = PATH_NOT_NUMBERS.search(argstring)
+        if bad: argstring = argstring[:bad.start()]
+        try:
+            numbers = [float(v) for v in argstring.replace(",", " ").split()]
+            ok = True
+        except ValueError:
+            numbers, ok = read_path_numbers(argstring)
+        groups = [numbers[i:i + count] for i in range(0, len(numbers) - count + 1, count)]
+        return groups, ok and not bad and len(numbers) > 0 and len(numbers) % count == 0
+
     def parse_path(self, node):
+        """Turns path data into absolute move_to/line_to/curve_to/close_path
+           instructions in one pass. Quadratic curves and arcs become cubic
+           curves here, so there's nothing to work out when drawing."""
         if not self.expect(node, ["d"]): return
-        d = node.getAttribute("d").split()
+        d = node.get("d")
         instructions = []
-        mode = None
-        for item in d:
-            if item == "M":
-                mode = "move_to"
-            elif item == "m":
-                mode = "rel_move_to"
-            elif item == "l":
-                mode = "rel_line_to"
-            elif item == "L":
-                mode = "line_to"
-            elif item == "Z" or item == "z":
-                instructions.append(["close_path", []])
-            elif mode == "move_to":
-                parts = [float(x) for x in item.split(",")]
-                instructions.append(["move_to", parts])
-                mode = "line_to"
-            elif mode == "rel_line_to":
-                parts = [float(x) for x in item.split(",")]
-                instructions.append(["rel_line_to", parts])
-            elif mode == "line_to":
-                parts = [float(x) for x in item.split(",")]
-                instructions.append(["line_to", parts])
-            else:
-                if self.debug:
-                    print("Confused by path instruction '%s' in path '%s'" % (item, d))
-                return
-        return instructions
+        append = instructions.append
+        x = y = 0.0 # current point
+        start_x = start_y = 0.0 # where the current subpath started
+        cubic_control = None # last control points, for reflecting in S and T
+        quad_control = None
+        ok = d.lstrip()[:1] in ("M", "m")
+        segments = PATH_SEGMENT.findall(d) if ok else []
+        for cmd, argstring in segments:
+            upper = cmd.upper()
+            relative = cmd != upper
+            groups = None
+            if upper in ("M", "L") and not PATH_NOT_NUMBERS.search(argstring):
+                # most segments are a single point, so try that before anything else
+                try:
+                    px, py = argstring.replace(",", " ").split()
+                    groups = [[float(px), float(py)]]
+                except ValueError:
+                    pass
+            if groups is None:
+                groups, ok = self.read_path_arguments(upper, argstring)
+            if upper in ("M", "L"):
+                # by far the most common case, so it gets a quick loop of its own
+                for i, (px, py) in enumerate(groups):
+                    if relative:
+                        px += x
+                        py += y
+                    x, y = px, py
+                    if upper == "M" and i == 0:
+                        start_x, start_y = x, y
+                        append(["move_to", [x, y]])
+                    else:
+                        # coordinates after a moveto are implicit linetos
+                        append(["line_to", [x, y]])
+                cubic_control = quad_control = None
+                groups = []
+            for args in groups:
+                if relative:
+                    # offset every coordinate (but not arc radii etc)
+                    if upper == "H":
+                        args[0] += x
+                    elif upper == "V":
+                        args[0] += y
+                    elif upper == "A":
+                        args[5] += x
+                        args[6] += y
+                    else:
+                        args = [a + (y if i % 2 else x) for i, a in enumerate(args)]
+                next_cubic_control = next_quad_control = None
+                if upper == "H":
+                    x = args[0]
+                    append(["line_to", [x, y]])
+                elif upper == "V":
+                    y = args[0]
+                    append(["line_to", [x, y]])
+                elif upper == "C":
+                    append(["curve_to", args])
+                    next_cubic_control = args[2:4]
+                    x, y = args[4:6]
+                elif upper == "S":
+                    if cubic_control:
+                        c1 = [2 * x - cubic_control[0], 2 * y - cubic_control[1]]
+                    else:
+                        c1 = [x, y]
+                    append(["curve_to", c1 + args])
+                    next_cubic_control = args[0:2]
+                    x, y = args[2:4]
+                elif upper in ("Q", "T"):
+                    if upper == "Q":
+                        qx, qy, ex, ey = args
+                    elif quad_control:
+                        qx, qy = 2 * x - quad_control[0], 2 * y - quad_control[1]
+                        ex, ey = args
+                    else:
+                        qx, qy = x, y
+                        ex, ey = args
+                    append(["curve_to", [
+                        x + 2 / 3 * (qx - x), y + 2 / 3 * (qy - y),
+                        ex + 2 / 3 * (qx - ex), ey + 2 / 3 * (qy - ey), ex, ey]])
+                    next_quad_control = [qx, qy]
+                    x, y = ex, ey
+                elif upper == "A":
+                    instructions += arc_to_curves(x, y, args[0], args[1], args[2],
+                        bool(args[3]), bool(args[4]), args[5], args[6])
+                    x, y = args[5:7]
+                elif upper == "Z":
+                    append(["close_path", []])
+                    x, y = start_x, start_y
+                cubic_control = next_cubic_control
+                quad_control = next_quad_control
+            if not ok: break
+        if ok: return instructions
+        if self.debug:
+            print("Confused by path data '%s' in path '%s'" % (
+                (cmd + argstring)[:20] if segments else d[:20], d))
+        # like a browser, draw everything up to the mistake
+        if instructions: return instructions
 
     def read_textbox(self, node):
-        if node.nodeName == "rect":
+        if node.tag == "rect":
             if not self.expect(node, ["x", "y", "width", "height"]): return
             return [
-                float(node.getAttribute("x")),
-                float(node.getAttribute("y")),
-                float(node.getAttribute("width")),
-                float(node.getAttribute("height"))
+                float(node.get("x")),
+                float(node.get("y")),
+                float(node.get("width")),
+                float(node.get("height"))
             ]
         else:
             if self.debug:
-                print("Unknown textbox element <%s>" % (node.nodeName,))
+                print("Unknown textbox element <%s>" % (node.tag,))
         return None
 
-    def convert(self):
-        if self.converted_result: return self.converted_result
-        dom = minidom.parseString(self.svg_string)
-        instructions = []
-        if not dom.documentElement.hasAttribute("viewBox"):
+    def read_viewbox(self, node):
+        if "viewBox" not in node.attrib:
             raise Exception("No viewBox attribute on <svg>")
-        viewBox = dom.documentElement.getAttribute("viewBox")
+        viewBox = node.get("viewBox")
         try:
             x, y, width, height = viewBox.split()
         except:
@@ -259,46 +817,159 @@ class SVG2Cairo(object):
         if x != "0" or y != "0":
             raise Exception("viewBox attribute ('%s') was too complex for me" % (viewBox,))
         try:
-            width = float(width)
-            height = float(height)
+            return float(width), float(height)
         except:
             raise Exception("viewBox attribute ('%s') was too complex for me (strange width/height)" % (viewBox,))
 
+    @tracing.traced("svg.convert")
+    def convert(self):
+        """Streams through the SVG with iterparse, emitting instructions for
+           each element as it starts, so we never build a whole DOM; elements
+           are thrown away again as soon as they end, and anything inside
+           one of the IGNORE_ELEMENTS is skipped without being looked at."""
+        if self.converted_result: return self.converted_result
+        if self.pack_entry:
+            self.converted_result = self.pack_entry.converted_result()
+            return self.converted_result
+        svg = self.svg_string
+        if isinstance(svg, str): svg = svg.encode("utf-8")
+        instructions = []
+        width = height = None
         textbox = None
         rotator = None
-        nodelist = dom.documentElement.getElementsByTagName("*")
-        for c in nodelist:
-            if c.nodeType == 1:
-                if c.nodeName in self.IGNORE_ELEMENTS: continue
-                if c.getAttribute("id") == "textbox":
-                    textbox = self.read_textbox(c)
-                handler = getattr(self, "parse_" + c.nodeName, None)
-                if handler:
-                    result = handler(c)
-                    if type(result) is type([]):
-                        style_result = None
-                        transform = None
-                        if c.hasAttribute("style"):
-                            style_result = self.read_style(c.getAttribute("style"))
-                        if c.hasAttribute("transform"):
-                            transform = self.read_transform(c.getAttribute("transform"))
-                        if transform:
-                            instructions.append(["save", []])
-                            instructions.append(["multiply_by_matrix", [transform]])
-                        instructions += result
-                        if style_result:
-                            instructions += style_result
-                        if transform:
-                            instructions.append(["restore", []])
+        # ElementTree names elements {namespace-uri}name; we want the
+        # prefix:name form they're written with, so remember the prefixes
+        prefixes = {}
+        ignoring = 0
+        # the transform in effect for each element we're inside
+        matrices = []
+        for event, node in ElementTree.iterparse(io.BytesIO(svg), events=("start", "end", "start-ns")):
+            if event == "start-ns":
+                prefix, uri = node
+                if uri not in prefixes or not prefix: prefixes[uri] = prefix
+                continue
+            if event == "end":
+                if ignoring:
+                    ignoring -= 1
                 else:
-                    if self.debug:
-                        print("Unknown SVG element <%s>" % (c.nodeName,))
+                    matrices.pop()
+                node.clear()
+                continue
+            if ignoring:
+                ignoring += 1
+                continue
+            if node.tag[0] == "{":
+                uri, name = node.tag[1:].split("}", 1)
+                if prefixes.get(uri): name = prefixes[uri] + ":" + name
+                node.tag = name
+            if width is None:
+                # the first element is the <svg> itself
+                width, height = self.read_viewbox(node)
+                matrices.append(cairo.Matrix())
+                continue
+            if node.tag in self.IGNORE_ELEMENTS:
+                ignoring = 1
+                continue
+            matrix = matrices[-1]
+            if "transform" in node.attrib:
+                transform = self.read_transform(node.get("transform"))
+                if transform:
+                    matrix = transform.multiply(matrix)
+            matrices.append(matrix)
+            identity = _is_identity(matrix)
+            if node.get("id") == "textbox":
+                textbox = self.read_textbox(node)
+                if textbox and not identity:
+                    corners = [matrix.transform_point(textbox[0] + dx, textbox[1] + dy)
+                        for dx in (0, textbox[2]) for dy in (0, textbox[3])]
+                    xs = [c[0] for c in corners]
+                    ys = [c[1] for c in corners]
+                    textbox = [min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys)]
+            handler = getattr(self, "parse_" + node.tag, None)
+            if handler:
+                result = handler(node)
+                if type(result) is type([]):
+                    style_result = None
+                    if "style" in node.attrib:
+                        style_result = self.read_style(node.get("style"))
+                    if not identity:
+                        result = self.bake_transform(result, matrix)
+                        if style_result:
+                            # line widths scale along with everything else
+                            line_scale = math.sqrt(abs(matrix.xx * matrix.yy - matrix.xy * matrix.yx))
+                            style_result = [[cmd, [params[0] * line_scale]] if cmd == "set_line_width"
+                                else [cmd, params] for cmd, params in style_result]
+                    instructions += result
+                    if style_result:
+                        instructions += style_result
+            elif node.tag in self.GROUP_ELEMENTS:
+                pass
+            else:
+                if self.debug:
+                    print("Unknown SVG element <%s>" % (node.tag,))
+        if self.optimize:
+            unoptimized_count = len(instructions)
+            instructions = optimize_instructions(instructions)
+            if self.debug:
+                print("Optimized %s instructions down to %s" % (unoptimized_count, len(instructions)))
         self.converted_result = {
             "width": width, "height": height, "instructions": instructions,
             "textbox": textbox, "rotator": rotator
         }
         return self.converted_result
 
+    def clone(self):
+        """A copy of this bubble which shares its converted instructions (which
+           nothing changes) but has its own text layout and no recordings, so
+           that it can be drawn in another thread while this one's drawn here."""
+        other = SVG2Cairo(debug=self.debug, optimize=self.optimize)
+        other.svg_string = self.svg_string
+        other.pack_entry = self.pack_entry
+        other.converted_result = self.convert()
+        return other
+
+    def outline_margin(self):
+        """How far outside its box this bubble can draw, in pixels. Line
+           widths don't change with the size it's drawn at, so neither does
+           this: it's the widest stroke's mitered corners."""
+        widths = [params[0] for cmd, params in self.convert()["instructions"]
+            if cmd == "set_line_width"]
+        return max(widths, default=0) / 2 * self.MITER_LIMIT
+
+    def text_layout(self):
+        """The Pango layout this bubble's text is fitted and drawn with; made
+           once and then reused for every frame."""
+        if self.layout is None:
+            self.layout = new_text_layout()
+        return self.layout
+
+    def replay_instructions(self, context, instructions, scale):
+        for cmd, params in instructions:
+            if self.debug: print (cmd, params)
+            if cmd == "set_line_width":
+                getattr(context, cmd)(params[0] * (1/scale))
+            else:
+                getattr(context, cmd)(*params)
+
+    @tracing.traced("svg.compile")
+    def compile(self, scale):
+        """Returns a cairo.RecordingSurface with the converted instructions
+           already drawn on it, in viewBox coordinates, with line widths set
+           up for drawing at roughly this scale."""
+        bucket = round(math.log2(max(abs(scale), self.MIN_SCALE)) * self.SCALE_BUCKETS_PER_DOUBLING)
+        recording = self.recordings.get(bucket)
+        if recording:
+            self.recordings.move_to_end(bucket)
+            return recording
+        result = self.convert()
+        recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+        self.replay_instructions(cairo.Context(recording), result["instructions"],
+            2 ** (bucket / self.SCALE_BUCKETS_PER_DOUBLING))
+        self.recordings[bucket] = recording
+        while len(self.recordings) > self.MAX_RECORDINGS:
+            self.recordings.popitem(last=False)
+        return recording
+
     def render_to_context_at_size_with_text(self, context, x, y, width, height, text=None, font_name=None):
         """Renders this SVG inside a box of max-size width x height at 0,0
            This preserves aspect ratio.
@@ -319,6 +990,11 @@ class SVG2Cairo(object):
         width_scale = width / result["width"]
         height_scale = height / result["height"]
         scale = min(width_scale, height_scale)
+        if scale <= 0:
+            # a box with no size (like a bubble dragged down to nothing), so
+            # there's nothing to draw, and cairo can't scale by zero anyway
+            context.restore()
+            return {"width": 0, "height": 0}
         context.translate(x, y)
         try:
             context.scale(scale, scale)
@@ -328,17 +1004,16 @@ class SVG2Cairo(object):
             sys.exit(1)
             raise
 
-        for cmd, params in result.get("instructions", []):
-            if self.debug: print (cmd, params)
-            if cmd == "set_line_width":
-                getattr(context, cmd)(params[0] * (1/scale))
-            else:
-                getattr(context, cmd)(*params)
+        if self.compiled:
+            context.set_source_surface(self.compile(scale), 0, 0)
+            context.paint()
+        else:
+            self.replay_instructions(context, result.get("instructions", []), scale)
 
         if text and font_name:
             rt = result.get("textbox", None)
             if rt:
-                ly = fit_text(text, font_name, rt[2], rt[3])
+                ly = fit_text(text, font_name, rt[2], rt[3], self.text_layout())
                 sz = ly.get_pixel_size()
                 dx = (rt[2] - sz.width) / 2
                 dy = (rt[3] - sz.height) / 2
@@ -368,7 +1043,56 @@ class SVG2Cairo(object):
         base.write_to_png(to_png)
 
 
+def compare_optimized(svg_string, sizes=(100, 400, 1200), text="This is a journey\ninto sound."):
+    """Renders svg_string with and without optimize_instructions, at each of
+       sizes pixels wide and its own shape, onto ImageSurfaces, and compares
+       them pixel by pixel. Prints the instruction counts and, for each size,
+       how many pixels came out different and by how much; returns a list of
+       (width, height, pixels differing, biggest difference) for each size.
+       Antialiasing means a few edge pixels can differ slightly, where
+       strokes which were drawn one at a time are now drawn together."""
+    plain = SVG2Cairo(optimize=False)
+    plain.set_svg_as_string_sync(svg_string)
+    optimized = SVG2Cairo(optimize=True)
+    optimized.set_svg_as_string_sync(svg_string)
+    result = plain.convert()
+    print("Instructions: %s before, %s after" % (
+        len(result["instructions"]), len(optimized.convert()["instructions"])))
+    results = []
+    for size in sizes:
+        width = size
+        height = max(int(round(size * result["height"] / result["width"])), 1)
+        rows = []
+        for s2c in (plain, optimized):
+            base = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+            s2c.render_to_context_at_size_with_text(cairo.Context(base), 0, 0, width, height,
+                text, "Sans")
+            base.flush()
+            data = bytes(base.get_data())
+            stride = base.get_stride()
+            rows.append([data[y * stride:y * stride + width * 4] for y in range(height)])
+        differing = 0
+        worst = 0
+        for a, b in zip(*rows):
+            if a == b: continue
+            for i in range(0, width * 4, 4):
+                if a[i:i + 4] != b[i:i + 4]:
+                    differing += 1
+                    worst = max([worst] + [abs(a[j] - b[j]) for j in range(i, i + 4)])
+        print("%sx%s: %s of %s pixels differ, by at most %s" % (
+            width, height, differing, width * height, worst))
+        results.append((width, height, differing, worst))
+    return results
+
 if __name__ == "__main__":
+    if sys.argv[1] == "--compare-optimized":
+        for filename in sys.argv[2:]:
+            print(filename)
+            fp = open(filename)
+            svg_string = fp.read().encode("utf-8")
+            fp.close()
+            compare_optimized(svg_string)
+        sys.exit(0)
     incoming_svg = sys.argv[1]
     outgoing_png = sys.argv[2]
     fp = open(incoming_svg)
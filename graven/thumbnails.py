@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""Thumbnails for the bubble menu, made in the background and cached on disk.
+
+Each thumbnail is a PNG in the cache folder, named after a hash of the
+bubble's path and mtime; so an edited bubble just gets a new thumbnail, and
+prune() clears out the ones nobody's asked for this time around.
+"""
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, Gio, GLib
+import hashlib
+import os
+from tracing import log
+
+THUMBNAIL_SIZE = (100, 75)
+
+class ThumbnailCache(object):
+    # how many thumbnails to make at once; there's no point in having hundreds
+    # of them fighting over the GIO thread pool
+    MAX_CONCURRENT = 4
+
+    def __init__(self, folder, size=THUMBNAIL_SIZE):
+        self.folder = folder
+        self.size = size
+        self.queue = []
+        self.running = 0
+        self.live = set()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        details = "%s\0%s\0%sx%s" % (path, st.st_mtime_ns, self.size[0], self.size[1])
+        return hashlib.sha1(details.encode("utf-8")).hexdigest()
+
+    def filename_for(self, key):
+        return os.path.join(self.folder, key + ".png")
+
+    def request(self, path, callback, *args):
+        """Calls callback(pixbuf, *args) with the thumbnail for path: straight
+           away if it's in the cache, and otherwise once it's been made."""
+        key = self.key(path)
+        if key is None:
+            log.warning("Can't thumbnail missing bubble '%s'", path)
+            return
+        self.live.add(key)
+        try:
+            pb = GdkPixbuf.Pixbuf.new_from_file(self.filename_for(key))
+        except GLib.Error:
+            pb = None
+        if pb:
+            self.hits += 1
+            callback(pb, *args)
+            return
+        self.misses += 1
+        self.queue.append((path, key, callback, args))
+        self.start_next()
+
+    def start_next(self):
+        while self.queue and self.running < self.MAX_CONCURRENT:
+            job = self.queue.pop(0)
+            self.running += 1
+            Gio.File.new_for_path(job[0]).read_async(GLib.PRIORITY_LOW, None, self.opened, job)
+
+    def opened(self, f, res, job):
+        try:
+            stream = f.read_finish(res)
+        except GLib.Error as e:
+            self.failed(job, e)
+            return
+        GdkPixbuf.Pixbuf.new_from_stream_at_scale_async(stream, self.size[0], self.size[1],
+            True, None, self.made, (job, stream))
+
+    def made(self, source, res, data):
+        job, stream = data
+        path, key, callback, args = job
+        stream.close()
+        try:
+            pb = GdkPixbuf.Pixbuf.new_from_stream_finish(res)
+        except GLib.Error as e:
+            self.failed(job, e)
+            return
+        self.save(key, pb)
+        callback(pb, *args)
+        self.finished()
+
+    def save(self, key, pb):
+        filename = self.filename_for(key)
+        tmp = filename + ".tmp"
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            pb.savev(tmp, "png", [], [])
+            os.replace(tmp, filename)
+        except (OSError, GLib.Error) as e:
+            # no cache, then; we'll just make it again next time
+            log.warning("Couldn't cache thumbnail '%s': %s", filename, e)
+
+    def failed(self, job, e):
+        log.warning("Couldn't make a thumbnail for '%s': %s", job[0], e)
+        self.finished()
+
+    def finished(self):
+        self.running -= 1
+        self.start_next()
+
+    def prune(self):
+        """Removes every cached thumbnail which hasn't been requested since
+           this cache was made: ones for bubbles which have since been
+           edited or deleted, and any temporary files left behind by a crash."""
+        try:
+            entries = list(os.scandir(self.folder))
+        except OSError:
+            return
+        removed = 0
+        for entry in entries:
+            # (a live key's .tmp file is a thumbnail being saved right now)
+            if entry.name.split(".")[0] in self.live: continue
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except OSError:
+                pass
+        log.debug("Thumbnail cache: %s hits, %s misses, %s pruned", self.hits, self.misses, removed)
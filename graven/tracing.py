@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""Logging and tracing for graven.
+
+Log through `log` (the "graven" logger) rather than printing; set
+GRAVEN_LOG=debug in the environment to see everything.
+
+Tracing is off unless GRAVEN_TRACE=somefile.json is set or graven is run
+with --trace somefile.json. When it's on, every span() and @traced function
+is recorded, and when graven exits the lot is written out in Chrome's
+trace-event format, which chrome://tracing, Perfetto and friends can open.
+When it's off, span() and @traced cost next to nothing, so they're fine to
+leave in the draw handlers.
+
+`startup` keeps a note of how long the bits of starting up took, from when
+this module was first imported; graven --startup-profile prints it out.
+"""
+
+import atexit
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+log = logging.getLogger("graven")
+
+class _NullSpan(object):
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+NULL_SPAN = _NullSpan()
+
+class _Span(object):
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+class Tracer(object):
+    def __init__(self):
+        self.filename = None
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def start(self, filename):
+        if self.filename: return
+        self.filename = filename
+        self.events.append({"name": "process_name", "ph": "M", "pid": os.getpid(),
+            "args": {"name": "graven"}})
+        atexit.register(self.save)
+        log.info("Tracing to %s", filename)
+
+    def span(self, name, **args):
+        if self.filename is None: return NULL_SPAN
+        return _Span(self, name, args)
+
+    def add(self, name, start, end, args=None):
+        event = {
+            "name": name, "cat": name.split(".")[0], "ph": "X",
+            "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6,
+            "pid": os.getpid(), "tid": threading.get_ident()
+        }
+        if args: event["args"] = args
+        with self.lock:
+            self.events.append(event)
+
+    def save(self):
+        if not self.filename: return
+        with self.lock:
+            events = list(self.events)
+        try:
+            with open(self.filename, "w") as fp:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+        except OSError as e:
+            log.error("Couldn't write trace to %s: %s", self.filename, e)
+
+tracer = Tracer()
+
+class StartupProfile(object):
+    """Timings for the things that happen while starting up. These are
+       always recorded (there are only a dozen or so of them) and only
+       printed if someone asks."""
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.steps = []
+
+    def mark(self, name):
+        """Records that something has just happened."""
+        now = time.perf_counter()
+        self.steps.append((name, now, now))
+
+    def timed(self, name):
+        """A context manager which records how long its body takes."""
+        return _StartupStep(self, name)
+
+    def add(self, name, start, end):
+        self.steps.append((name, start, end))
+        if tracer.filename: tracer.add("startup." + name, start, end)
+
+    def report(self, fp=None):
+        fp = fp or sys.stdout
+        fp.write("Startup profile (ms since graven started):\n")
+        fp.write("%9s %9s  %s\n" % ("at", "took", "step"))
+        for name, start, end in sorted(self.steps, key=lambda step: step[1]):
+            took = "%9.1f" % ((end - start) * 1000,) if end > start else " " * 9
+            fp.write("%9.1f %s  %s\n" % ((end - self.origin) * 1000, took, name))
+        fp.flush()
+
+class _StartupStep(object):
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.add(self.name, self.start, time.perf_counter())
+        return False
+
+startup = StartupProfile()
+
+def span(name, **args):
+    """A context manager which records how long its body takes, if tracing."""
+    return tracer.span(name, **args)
+
+def traced(name):
+    """Decorator: records a span for every call of the function, if tracing."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if tracer.filename is None: return fn(*args, **kwargs)
+            with _Span(tracer, name, None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def setup(trace_file=None):
+    """Sets up logging from GRAVEN_LOG, and starts tracing if trace_file or
+       GRAVEN_TRACE says to."""
+    level = getattr(logging, os.environ.get("GRAVEN_LOG", "warning").upper(), logging.WARNING)
+    logging.basicConfig(level=level, format="%(name)s %(levelname)s: %(message)s")
+    trace_file = trace_file or os.environ.get("GRAVEN_TRACE")
+    if trace_file:
+        tracer.start(trace_file)
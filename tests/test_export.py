@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+"""Tests for deciding which bubbles a tiled export draws on each strip."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "graven"))
+try:
+    import export
+    import svg2cairo
+except (ImportError, ValueError):
+    # needs PyGObject with Gdk and GdkPixbuf, and pycairo
+    export = None
+
+BUBBLES = os.path.join(os.path.dirname(__file__), "..", "bubbles")
+
+@unittest.skipIf(export is None, "needs Gdk, GdkPixbuf and pycairo")
+class StripOverlapsTest(unittest.TestCase):
+    def test_small_bubble_just_above_a_strip(self):
+        # a 10 pixel high bubble ending 4 pixels above the strip; its 20
+        # pixel outline still reaches down into it
+        margin = 20 / 2
+        area = (100, 240, 30, 10)
+        self.assertTrue(export.strip_overlaps(area, 254, 510, margin))
+        self.assertTrue(export.strip_overlaps(area, 0, 236, margin))
+        self.assertFalse(export.strip_overlaps(area, 261, 517, margin))
+        self.assertFalse(export.strip_overlaps(area, 0, 229, margin))
+
+    def test_margin_is_the_same_at_any_size(self):
+        s2c = svg2cairo.SVG2Cairo()
+        with open(os.path.join(BUBBLES, "speech.bubble.svg")) as fp:
+            s2c.set_svg_as_string_sync(fp.read())
+        margin = s2c.outline_margin()
+        widths = [params[0] for cmd, params in s2c.convert()["instructions"]
+            if cmd == "set_line_width"]
+        self.assertGreaterEqual(margin, max(widths) / 2)
+        for h in (4, 40, 4000):
+            self.assertTrue(export.strip_overlaps((0, 256 - h - margin + 1, 10, h),
+                256, 512, margin))
+
+if __name__ == "__main__":
+    unittest.main()
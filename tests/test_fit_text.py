@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+"""Tests for the font size solver behind fit_text, against the search it
+replaced. The layout here is a stand-in with made-up glyph widths, so the
+answers don't depend on which fonts are installed."""
+
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "graven"))
+try:
+    import svg2cairo
+except (ImportError, ValueError):
+    # needs PyGObject with Pango, and pycairo
+    svg2cairo = None
+
+TEXTS = [
+    "LOL",
+    "This is a journey into sound. Stereophonic sound. " * 4,
+    "The mask.\nThe ray-traced picture.\nAnd finally,\nthe wireframe city.\n" * 2,
+    "no\nway"
+]
+BOXES = [(20, 20), (200, 100), (794.28577, 437.14285), (682.85724, 397.14288),
+    (800, 600), (3000, 2000), (4000, 25)]
+
+class PixelSize(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+class FontDescription(object):
+    def set_absolute_size(self, size):
+        self.size = size
+
+class ModelLayout(object):
+    """Enough of a Pango.Layout for the solver: every letter has its own
+       width in ems and lines are 1.2 ems apart; hinted, each letter and
+       line is a whole number of pixels, as with hint metrics on."""
+    def __init__(self, text, hinted):
+        self.lines = text.split("\n")
+        self.hinted = hinted
+        self.size = 0
+    def set_font_description(self, fd):
+        self.size = fd.size
+    def get_size(self):
+        scale = svg2cairo.Pango.SCALE
+        pixels = self.size / scale
+        def hint(value):
+            return round(value) if self.hinted else value
+        width = max(sum(hint((0.3 + (ord(c) * 37 % 100) / 220) * pixels) for c in line)
+            for line in self.lines)
+        height = hint(1.2 * pixels) * len(self.lines)
+        return int(width * scale), int(height * scale)
+    def get_pixel_size(self):
+        width, height = self.get_size()
+        scale = svg2cairo.Pango.SCALE
+        return PixelSize(math.ceil(width / scale), math.ceil(height / scale))
+
+def old_search(ly, fd, max_width, max_height):
+    """fit_text's original search, as it was: double from 100 until too big,
+       then binary search. Returns the size it found and how many it tried."""
+    probes = 0
+    size = 100
+    while 1:
+        probes += 1
+        fd.set_absolute_size(size)
+        ly.set_font_description(fd)
+        s = ly.get_pixel_size()
+        if s.width > max_width or s.height > max_height:
+            break
+        size = size * 2
+    first = 0
+    last = size
+    while first <= last:
+        probes += 1
+        midpoint = ((first + last) // 2)
+        fd.set_absolute_size(midpoint)
+        ly.set_font_description(fd)
+        s = ly.get_pixel_size()
+        if s.width < max_width and s.height < max_height:
+            first = midpoint + 1
+        else:
+            last = midpoint - 1
+    return max(first - 1, 1), probes
+
+@unittest.skipIf(svg2cairo is None, "needs Pango and pycairo")
+class SolveFontSizeTest(unittest.TestCase):
+    def compare(self, hinted, start):
+        """Solves every text in every box; returns (old probes, new probes)."""
+        old_total = new_total = 0
+        for text in TEXTS:
+            for w, h in BOXES:
+                expected, old_probes = old_search(ModelLayout(text, hinted),
+                    FontDescription(), w, h)
+                svg2cairo.fit_cache.probes = 0
+                size = svg2cairo._solve_font_size(ModelLayout(text, hinted),
+                    FontDescription(), w, h, start)
+                with self.subTest(text=text[:20], box=(w, h), hinted=hinted, start=start):
+                    self.assertEqual(size, expected)
+                old_total += old_probes
+                new_total += svg2cairo.fit_cache.probes
+        return old_total, new_total
+
+    def test_unhinted_matches_old_search(self):
+        for start in (64 * 1024, 1, 5000000):
+            old_total, new_total = self.compare(False, start)
+            # a handful each, against the old search's 15 to 35
+            self.assertLessEqual(new_total, len(TEXTS) * len(BOXES) * 6)
+
+    def test_hinted_matches_old_search(self):
+        for start in (64 * 1024, 1, 5000000):
+            old_total, new_total = self.compare(True, start)
+            self.assertLess(new_total, old_total)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""Tests for the undo history and its render cache."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "graven"))
+import history
+
+INTERVAL = history.History.CHECKPOINT_INTERVAL
+
+class FakeRender(object):
+    """Something with a size, like a pixbuf, for the render cache."""
+    def __init__(self, size):
+        self.size = size
+    def __len__(self):
+        return self.size
+
+def texts(state):
+    return [b.text for b in state.bubbles]
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.history = history.History()
+        self.history.do(history.AddBubble(None, (0, 0, 0.5, 0.5), "0"))
+
+    def do_texts(self, count):
+        """Changes the bubble's text count times, to "1", "2", ..."""
+        start = self.history.position
+        for n in range(start, start + count):
+            self.history.do(history.SetBubbleText(0, str(n)))
+
+    def test_undo_redo_across_checkpoints(self):
+        self.do_texts(INTERVAL * 2 + 3)
+        self.assertEqual(sorted(self.history.checkpoints), [0, INTERVAL, INTERVAL * 2])
+        top = self.history.position
+        for position in range(top - 1, 0, -1):
+            state = self.history.undo()
+            self.assertEqual(self.history.position, position)
+            self.assertEqual(texts(state), [str(position - 1)])
+        self.assertEqual(texts(self.history.undo()), [])
+        self.assertFalse(self.history.can_undo())
+        while self.history.can_redo():
+            state = self.history.redo()
+            self.assertEqual(state, self.history.state_at(self.history.position))
+        self.assertEqual(self.history.position, top)
+        self.assertEqual(texts(self.history.state), [str(top - 1)])
+
+    def test_state_at_checkpoint_boundary(self):
+        self.do_texts(INTERVAL)
+        for position in (INTERVAL - 1, INTERVAL, INTERVAL + 1):
+            self.assertEqual(texts(self.history.state_at(position)), [str(position - 1)])
+
+    def test_names(self):
+        self.assertEqual(self.history.undo_name(), "Add Bubble")
+        self.assertEqual(self.history.redo_name(), None)
+        self.history.undo()
+        self.assertEqual(self.history.undo_name(), None)
+        self.assertEqual(self.history.redo_name(), "Add Bubble")
+
+    def test_do_after_undo_truncates(self):
+        self.do_texts(INTERVAL * 2)
+        self.history.render("test", lambda state: FakeRender(10), INTERVAL)
+        self.history.render("test", lambda state: FakeRender(10), INTERVAL + 1)
+        for i in range(INTERVAL):
+            self.history.undo()
+        self.assertEqual(self.history.position, INTERVAL + 1)
+        self.history.undo()
+        self.history.do(history.SetBubbleText(0, "new"))
+        self.assertEqual(len(self.history.operations), INTERVAL + 1)
+        self.assertFalse(self.history.can_redo())
+        # the checkpoint at INTERVAL * 2 and the render after INTERVAL were
+        # for edits that are gone now
+        self.assertEqual(sorted(self.history.checkpoints), [0, INTERVAL])
+        self.assertEqual(list(self.history.renders), [("test", INTERVAL)])
+        self.assertEqual(self.history.render_bytes, 10)
+        self.assertEqual(texts(self.history.state), ["new"])
+
+    def test_render_is_cached(self):
+        made = []
+        def make(state):
+            made.append(state)
+            return FakeRender(10)
+        first = self.history.render("test", make)
+        self.assertIs(self.history.render("test", make), first)
+        self.assertEqual(len(made), 1)
+        self.assertEqual(made[0], self.history.state)
+
+    def test_eviction(self):
+        self.history.set_render_budget(25)
+        for position in (0, 1):
+            self.history.render("test", lambda state: FakeRender(10), position)
+        # using 0 again makes 1 the least recently used
+        self.history.render("test", None, 0)
+        self.history.cache_render(("other", 1), FakeRender(10))
+        self.assertEqual(list(self.history.renders), [("test", 0), ("other", 1)])
+        self.assertEqual(self.history.render_bytes, 20)
+        self.history.set_render_budget(15)
+        self.assertEqual(list(self.history.renders), [("other", 1)])
+        self.assertEqual(self.history.render_bytes, 10)
+
+    def test_render_bigger_than_budget(self):
+        self.history.set_render_budget(5)
+        render = self.history.render("test", lambda state: FakeRender(10))
+        self.assertEqual(len(render), 10)
+        self.assertEqual(len(self.history.renders), 0)
+        self.assertEqual(self.history.render_bytes, 0)
+
+    def test_flatten(self):
+        self.history.do(history.Crop(((0.1, 0.1), (0.9, 0.9))))
+        position = self.history.position
+        self.history.cache_render(("flatten", position), FakeRender(10))
+        state = self.history.do(history.Flatten(position))
+        self.assertEqual(state, history.initial_state()._replace(base=position))
+        self.assertEqual(self.history.undo_name(), "Apply")
+        # undoing it goes back to the crop and bubble, not yet flattened
+        state = self.history.undo()
+        self.assertEqual(state.base, None)
+        self.assertEqual(texts(state), ["0"])
+        self.assertEqual(state.crop_rect, ((0.1, 0.1), (0.9, 0.9)))
+        self.assertIn(("flatten", position), self.history.renders)
+
+    def image_pixels(self, state, width=1000, height=800):
+        """Where the bubble is on a width x height photo, in pixels."""
+        (left, top), (right, bottom) = state.crop_rect
+        box = state.bubbles[0].box
+        xs = [(left + box[i] * (right - left)) * width for i in (0, 2)]
+        ys = [(top + box[i] * (bottom - top)) * height for i in (1, 3)]
+        return [round(v, 6) for v in (xs[0], ys[0], xs[1], ys[1])]
+
+    def test_crop_keeps_bubbles_on_the_same_pixels(self):
+        before = self.image_pixels(self.history.state)
+        state = self.history.do(history.Crop(((0.1, 0.2), (0.6, 0.9))))
+        self.assertEqual(self.image_pixels(state), before)
+        self.assertNotEqual(state.bubbles[0].box, (0, 0, 0.5, 0.5))
+        # and making the crop bigger again
+        state = self.history.do(history.Crop(((0.0, 0.05), (1.0, 1.0))))
+        self.assertEqual(self.image_pixels(state), before)
+        state = self.history.undo()
+        self.assertEqual(self.image_pixels(state), before)
+        state = self.history.undo()
+        self.assertEqual(state.bubbles[0].box, (0, 0, 0.5, 0.5))
+
+    def test_crop_to_nothing_leaves_bubbles(self):
+        state = self.history.do(history.Crop(((0.5, 0.5), (0.5, 0.7))))
+        self.assertEqual(state.bubbles[0].box, (0, 0, 0.5, 0.5))
+
+class RenderBudgetTest(unittest.TestCase):
+    def tearDown(self):
+        os.environ.pop("GRAVEN_RENDER_BUDGET_MB", None)
+
+    def test_default(self):
+        os.environ.pop("GRAVEN_RENDER_BUDGET_MB", None)
+        self.assertEqual(history.configured_render_budget(), history.History.DEFAULT_RENDER_BUDGET)
+
+    def test_from_environment(self):
+        os.environ["GRAVEN_RENDER_BUDGET_MB"] = "64"
+        self.assertEqual(history.configured_render_budget(), 64 * 1024 * 1024)
+        os.environ["GRAVEN_RENDER_BUDGET_MB"] = "lots"
+        self.assertEqual(history.configured_render_budget(), history.History.DEFAULT_RENDER_BUDGET)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+"""Tests that optimizing a bubble's instructions doesn't change how it looks,
+by rendering the shipped bubbles both ways and comparing the pixels."""
+
+import glob
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "graven"))
+try:
+    import svg2cairo
+except (ImportError, ValueError):
+    # needs PyGObject with Pango, and pycairo
+    svg2cairo = None
+
+BUBBLES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "bubbles", "*.svg")))
+
+@unittest.skipIf(svg2cairo is None, "needs Pango and pycairo")
+class CompareOptimizedTest(unittest.TestCase):
+    def test_shipped_bubbles_look_the_same(self):
+        self.assertTrue(BUBBLES)
+        for filename in BUBBLES:
+            with open(filename, "rb") as fp:
+                svg_string = fp.read()
+            for width, height, differing, worst in svg2cairo.compare_optimized(svg_string):
+                with self.subTest(bubble=os.path.basename(filename), size=(width, height)):
+                    # only antialiased edges where strokes meet may differ
+                    self.assertLessEqual(differing, width * height // 100)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+"""Tests for reading SVG path data, and stopping where it goes wrong."""
+
+import os
+import sys
+import unittest
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "graven"))
+try:
+    import svg2cairo
+except (ImportError, ValueError):
+    # needs PyGObject with Pango, and pycairo
+    svg2cairo = None
+
+@unittest.skipIf(svg2cairo is None, "needs Pango and pycairo")
+class ParsePathTest(unittest.TestCase):
+    def parse(self, d):
+        return svg2cairo.SVG2Cairo().parse_path(ElementTree.Element("path", d=d))
+
+    def test_numbers_run_together(self):
+        self.assertEqual(self.parse("M0 0L1.5.5-3e2,4"), [
+            ["move_to", [0, 0]], ["line_to", [1.5, 0.5]], ["line_to", [-300, 4]]])
+
+    def test_unknown_letter_keeps_what_came_before(self):
+        self.assertEqual(self.parse("M0 0 L1 1 X 5"), [
+            ["move_to", [0, 0]], ["line_to", [1, 1]]])
+        self.assertEqual(self.parse("M0 0 z X"), [["move_to", [0, 0]], ["close_path", []]])
+
+    def test_incomplete_numbers_are_mistakes(self):
+        for d in ("M0 0 L1 1 2e", "M0 0 L1 1 2e 3", "M0 0 L1 1 2e+,3", "M0 0 L1 1 2,3e"):
+            with self.subTest(d=d):
+                self.assertEqual(self.parse(d), [["move_to", [0, 0]], ["line_to", [1, 1]]])
+        self.assertEqual(self.parse("M0 0 a5 5 0 0 1 5 5e"), [["move_to", [0, 0]]])
+        self.assertEqual(self.parse("M0 0 L1e2 2E-1"), [["move_to", [0, 0]], ["line_to", [100, 0.2]]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""Tests for finding bubbles and handles on the canvas."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "graven"))
+import scene
+
+class GridTest(unittest.TestCase):
+    def setUp(self):
+        self.grid = scene.Grid(cell_size=10)
+
+    def test_at_picks_the_top(self):
+        self.grid.put("bottom", (0, 0, 50, 50), 0)
+        self.grid.put("top", (20, 20, 50, 50), 1)
+        self.assertEqual(self.grid.at(30, 30), "top")
+        self.assertEqual(self.grid.at(5, 5), "bottom")
+        self.assertEqual(self.grid.at(65, 65), "top")
+        self.assertEqual(self.grid.at(90, 90), None)
+
+    def test_edges_are_outside(self):
+        self.grid.put("a", (10, 10, 10, 10), 0)
+        self.assertEqual(self.grid.at(10, 15), None)
+        self.assertEqual(self.grid.at(20, 15), None)
+        self.assertEqual(self.grid.at(15, 15), "a")
+
+    def test_negative_coordinates(self):
+        self.grid.put("a", (-25, -25, 20, 20), 0)
+        self.assertEqual(self.grid.at(-15, -15), "a")
+        self.assertEqual(self.grid.overlapping((-100, -100, 90, 90)), ["a"])
+
+    def test_put_moves(self):
+        self.grid.put("a", (0, 0, 10, 10), 0)
+        self.grid.put("a", (100, 100, 10, 10), 0)
+        self.assertEqual(self.grid.at(5, 5), None)
+        self.assertEqual(self.grid.at(105, 105), "a")
+        self.assertEqual(self.grid.overlapping((0, 0, 50, 50)), [])
+
+    def test_remove_empties_cells(self):
+        self.grid.put("a", (0, 0, 35, 35), 0)
+        self.grid.remove("a")
+        self.grid.remove("a")
+        self.assertEqual(len(self.grid.cells), 0)
+        self.assertEqual(self.grid.at(5, 5), None)
+
+    def test_overlapping_is_bottom_first_and_exact(self):
+        self.grid.put("c", (0, 0, 100, 100), 2)
+        self.grid.put("a", (40, 40, 5, 5), 0)
+        self.grid.put("b", (48, 48, 5, 5), 1)
+        # shares a cell with the area, but doesn't reach into it
+        self.grid.put("d", (56, 56, 2, 2), 3)
+        self.assertEqual(self.grid.overlapping((42, 42, 12, 12)), ["a", "b", "c"])
+
+    def test_negative_size_covers_nothing(self):
+        self.grid.put("backwards", (50, 50, -30, -30), 0)
+        self.grid.put("flat", (0, 0, 40, 0), 1)
+        for x, y in ((35, 35), (50, 50), (20, 0)):
+            self.assertEqual(self.grid.at(x, y), None)
+        self.assertEqual(self.grid.overlapping((0, 0, 100, 100)), [])
+        self.grid.remove("backwards")
+        self.grid.remove("flat")
+        self.assertEqual(len(self.grid.cells), 0)
+
+class SceneTest(unittest.TestCase):
+    def setUp(self):
+        self.scene = scene.Scene()
+        self.scene.set_bubbles([(0, 0, 100, 100), (50, 50, 100, 100), (300, 300, 50, 50)])
+
+    def test_hit_later_bubbles_are_on_top(self):
+        self.assertEqual(self.scene.hit(75, 75), ("bubble", 1))
+        self.assertEqual(self.scene.hit(25, 25), ("bubble", 0))
+        self.assertEqual(self.scene.hit(200, 200), None)
+
+    def test_handles_are_above_bubbles(self):
+        self.scene.set_handles([((90, 90, 12, 12), "br"), ((60, 60, 6, 6), "tl")])
+        self.assertEqual(self.scene.hit(95, 95), ("handle", "br"))
+        self.assertEqual(self.scene.hit(62, 62), ("handle", "tl"))
+        # handles never show up as bubbles
+        self.assertEqual(self.scene.bubbles_in((0, 0, 400, 400)), [0, 1, 2])
+
+    def test_set_handles_replaces_them(self):
+        self.scene.set_handles([((90, 90, 12, 12), "br")])
+        self.scene.set_handles([((310, 310, 6, 6), "tl")])
+        self.assertEqual(self.scene.hit(95, 95), ("bubble", 1))
+        self.assertEqual(self.scene.hit(312, 312), ("handle", "tl"))
+
+    def test_bubbles_in_is_bottom_first(self):
+        self.assertEqual(self.scene.bubbles_in((60, 60, 10, 10)), [0, 1])
+        self.assertEqual(self.scene.bubbles_in((120, 120, 200, 200)), [1, 2])
+        self.assertEqual(self.scene.bubbles_in((400, 0, 10, 10)), [])
+
+    def test_move_bubble_keeps_its_place(self):
+        self.scene.move_bubble(0, (60, 60, 20, 20))
+        # moved on top of bubble 1, but still underneath it
+        self.assertEqual(self.scene.hit(70, 70), ("bubble", 1))
+        self.assertEqual(self.scene.hit(25, 25), None)
+        self.assertEqual(self.scene.bubbles_in((65, 65, 5, 5)), [0, 1])
+
+    def test_bubble_resized_inside_out(self):
+        self.scene.move_bubble(1, (150, 150, -100, -100))
+        self.assertEqual(self.scene.hit(75, 75), ("bubble", 0))
+        self.assertEqual(self.scene.hit(125, 125), None)
+        self.assertEqual(self.scene.bubbles_in((0, 0, 400, 400)), [0, 2])
+
+if __name__ == "__main__":
+    unittest.main()